@@ -1,4 +1,13 @@
-from mechtex_rc_testbench.application import Application
+import sys
 
-app = Application()
-app.mainloop()
\ No newline at end of file
+# No arguments: the GUI. With arguments: a headless sweep (see cli.py), which
+# never imports tkinter or matplotlib.
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        from mechtex_rc_testbench import cli
+        sys.exit(cli.main())
+
+    from mechtex_rc_testbench.application import Application
+
+    app = Application()
+    app.mainloop()
@@ -0,0 +1,105 @@
+import threading
+from collections import deque
+import numpy as np
+
+# Timestamp alignment of the supply and Arduino streams
+#
+# Both streams are stamped with the host monotonic clock:
+#   supply   the middle of the MEAS query round trip (DeviceWorker), half
+#            the round trip is the supply's transport delay estimate
+#   arduino  the arrival of the batch (ArduinoReader), every sample also
+#            carries the board clock (us). board_to_host() puts the samples
+#            on the host clock: host - board is smallest for the samples
+#            that waited least, its lower envelope (per `window` seconds,
+#            following the drift of the board crystal) minus the Arduino's
+#            transport delay estimate (half the handshake round trip) is
+#            the clock offset.
+#
+# merge_asof() and interpolate() join the streams on whole NumPy arrays,
+# analysis.align_run() builds the aligned table of a run with them.
+#
+#   index = merge_asof(arduino_times, supply_times, tolerance=0.05)
+#   current = np.where(index >= 0, supply['current'][index], np.nan)
+
+
+class DelayEstimate:
+    # median of the last `size` one-way delay samples (s)
+
+    def __init__(self, size=256):
+        self.samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, delay):
+        with self._lock:
+            self.samples.append(delay)
+
+    def median(self):
+        with self._lock:
+            return float(np.median(self.samples)) if self.samples else None
+
+
+def unwrap_board_time(timestamp):
+    # board clock (u32 microseconds, wraps every 71.6 minutes) -> seconds
+    timestamp = np.asarray(timestamp, dtype='i8')
+    if not len(timestamp):
+        return np.zeros(0)
+    steps = np.diff(timestamp) % (1 << 32)
+    return (timestamp[0] + np.concatenate(([0], np.cumsum(steps)))) / 1e6
+
+
+def board_to_host(host, timestamp, window=5.0, delay=0.0):
+    # host time of every Arduino sample from the batch arrival times (host)
+    # and the board clock (timestamp, us), returns (time, arrival delay)
+    host = np.asarray(host, dtype='f8')
+    board = unwrap_board_time(timestamp)
+    if not len(board):
+        return np.zeros(0), np.zeros(0)
+    offset = host - board
+    chunk = ((board - board[0]) // window).astype('i8')
+    starts = np.flatnonzero(np.concatenate(([True], chunk[1:] != chunk[:-1])))
+    counts = np.diff(np.append(starts, len(board)))
+    envelope = np.minimum.reduceat(offset, starts)
+    centres = np.add.reduceat(board, starts) / counts
+    time = board + np.interp(board, centres, envelope) - delay
+    return time, host - time
+
+
+def merge_asof(left, right, direction='nearest', tolerance=None):
+    # index into right of the match of every left time, -1 where there is
+    # none; both sorted. direction: 'backward' (last right <= left),
+    # 'forward' (first right >= left) or 'nearest'
+    left = np.asarray(left, dtype='f8')
+    right = np.asarray(right, dtype='f8')
+    if not len(right):
+        return np.full(len(left), -1)
+    after = np.searchsorted(right, left, side='left')
+    before = np.searchsorted(right, left, side='right') - 1
+    if direction == 'backward':
+        index = before
+    elif direction == 'forward':
+        index = np.where(after < len(right), after, -1)
+    elif direction == 'nearest':
+        forward = np.minimum(after, len(right) - 1)
+        backward = np.maximum(before, 0)
+        closer = np.abs(right[forward] - left) < np.abs(left - right[backward])
+        index = np.where(closer, forward, backward)
+    else:
+        raise ValueError(f'Unknown merge direction {direction!r}')
+    if tolerance is not None:
+        matched = index >= 0
+        gap = np.abs(right[np.maximum(index, 0)] - left)
+        index = np.where(matched & (gap > tolerance), -1, index)
+    return index
+
+
+def interpolate(left, right, values, tolerance=None):
+    # values (sampled at the right times) linearly interpolated at the left
+    # times, NaN outside the right times and where the nearest right sample
+    # is further than tolerance
+    left = np.asarray(left, dtype='f8')
+    if not len(right):
+        return np.full(len(left), np.nan)
+    result = np.interp(left, right, values, left=np.nan, right=np.nan)
+    if tolerance is not None:
+        result[merge_asof(left, right, 'nearest', tolerance) < 0] = np.nan
+    return result
@@ -0,0 +1,259 @@
+import argparse
+import glob
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from . import alignment as al
+from . import storage as s
+
+# Post-processing of recorded runs
+#
+# A run is the set of files storage.RunWriter writes next to dest_file. The
+# raw supply and Arduino samples of every step are located by the step's
+# start / end host times, and all derived values are computed on whole
+# columns at once:
+#   rpm         from the electrical frequency of the RPM sensor and the poles
+#   power       electrical power V * I (W)
+#   efficiency  thrust per electrical power (gf/W)
+# Each step gets the mean and a confidence interval (normal approximation,
+# mean +- z * std / sqrt(n)) of every channel.
+#
+#   report = analyze_run('results/2207')
+#   write_report(report, 'results/2207_report.csv')
+#
+#   python -m mechtex_rc_testbench.analysis results/ --processes 8
+#
+# Runs recorded without start / end times (or without raw files) are
+# reported from the averaged step values, with no interval.
+#
+# align_run() joins the raw streams sample by sample on the host clock (see
+# alignment.py): every Arduino sample gets the supply voltage and current
+# interpolated at its time, so power and efficiency are right during
+# transients too.
+#
+#   python -m mechtex_rc_testbench.analysis results/ --align
+
+# files of a run that are not step result files themselves
+RUN_SUFFIXES = ('_supply', '_arduino', '_report', '_aligned')
+
+
+def electrical_frequency(period):
+    # RPM sensor pulse period (us) -> electrical frequency (Hz), 0 when stalled
+    period = np.asarray(period, dtype='f8')
+    return np.divide(1e6, period, out=np.zeros_like(period), where=period > 0)
+
+
+def rpm_from_frequency(frequency, num_poles):
+    # one mechanical revolution is num_poles / 2 electrical periods
+    return 120.0 * np.asarray(frequency, dtype='f8') / num_poles
+
+
+def electrical_power(voltage, current):
+    return np.asarray(voltage, dtype='f8') * np.asarray(current, dtype='f8')
+
+
+def thrust_efficiency(thrust, power):
+    # gf/W, NaN where no power was drawn
+    thrust = np.asarray(thrust, dtype='f8')
+    power = np.asarray(power, dtype='f8')
+    return np.divide(thrust, power, out=np.full_like(power, np.nan), where=power > 0)
+
+
+def segment_stats(times, values, starts, ends, z=1.96):
+    # count, mean and confidence half width of values[starts <= times <= ends]
+    # for every (start, end) pair, times must be sorted
+    values = np.asarray(values, dtype='f8')
+    low = np.searchsorted(times, starts, side='left')
+    high = np.searchsorted(times, ends, side='right')
+    count = high - low
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    squares = np.concatenate(([0.0], np.cumsum(values * values)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (sums[high] - sums[low]) / count
+        variance = ((squares[high] - squares[low]) - count * mean * mean) / (count - 1)
+        half_width = z * np.sqrt(np.maximum(variance, 0.0) / count)
+    mean[count == 0] = np.nan
+    half_width[count < 2] = np.nan
+    return count, mean, half_width
+
+
+def load_table(path, dtype):
+    # path without extension, .npy preferred over .csv, None if neither exists
+    if os.path.exists(path + '.npy'):
+        return np.load(path + '.npy')
+    if os.path.exists(path + '.csv'):
+        return np.loadtxt(path + '.csv', delimiter=',', skiprows=1, dtype=dtype, ndmin=1)
+    return None
+
+
+def load_run(dest_file):
+    dest_file = os.path.splitext(dest_file)[0]
+    steps = np.genfromtxt(dest_file + '.csv', delimiter=',', names=True, ndmin=1)
+    metadata = {}
+    if os.path.exists(dest_file + '_meta.json'):
+        with open(dest_file + '_meta.json') as file:
+            metadata = json.load(file)
+    return {
+        'steps': steps,
+        'supply': load_table(dest_file + '_supply', s.SUPPLY_DTYPE),
+        'arduino': load_table(dest_file + '_arduino', s.ARDUINO_DTYPE),
+        'metadata': metadata,
+    }
+
+
+def analyze_run(dest_file, num_poles=None, z=1.96):
+    # returns the per-step report as a dict of equal length columns
+    run = load_run(dest_file)
+    steps = run['steps']
+    num_poles = num_poles or run['metadata'].get('num_poles')
+    report = {
+        'step': steps['step'],
+        'voltage_set': steps['voltage_set'],
+        'pwm_set': steps['pwm_set'],
+    }
+    raw = run['supply'] is not None and run['arduino'] is not None \
+        and 'start' in steps.dtype.names and num_poles
+    if not raw:
+        # averaged values only
+        for name in ('voltage', 'current', 'thrust', 'rpm'):
+            report[name] = steps[name]
+            report[name + '_ci'] = np.full(len(steps), np.nan)
+        report['power'] = electrical_power(steps['voltage'], steps['current'])
+        report['power_ci'] = np.full(len(steps), np.nan)
+        report['efficiency'] = thrust_efficiency(steps['thrust'], report['power'])
+        return report
+
+    supply = run['supply']
+    arduino = run['arduino']
+    rpm = rpm_from_frequency(electrical_frequency(arduino['period']), num_poles)
+    channels = (
+        ('voltage', 'supply', supply['voltage']),
+        ('current', 'supply', supply['current']),
+        ('power', 'supply', electrical_power(supply['voltage'], supply['current'])),
+        ('thrust', 'arduino', arduino['thrust']),
+        ('rpm', 'arduino', rpm),
+    )
+    for name, source, values in channels:
+        times = run[source]['time']
+        count, mean, half_width = segment_stats(times, values, steps['start'], steps['end'], z)
+        report[name] = mean
+        report[name + '_ci'] = half_width
+        report['n_' + source] = count
+    report['efficiency'] = thrust_efficiency(report['thrust'], report['power'])
+    return report
+
+
+def align_run(dest_file, num_poles=None, method='linear', tolerance=None, window=5.0):
+    # one row per Arduino sample, returns a dict of equal length columns.
+    # method: 'linear' interpolates the supply readings, 'nearest' takes the
+    # closest one; tolerance (s, default three supply intervals) is the
+    # largest distance to a supply reading, beyond it they are NaN
+    run = load_run(dest_file)
+    supply = run['supply']
+    arduino = run['arduino']
+    if supply is None or arduino is None or not len(supply) or not len(arduino):
+        raise ValueError(f'{dest_file}: no raw supply and Arduino samples')
+    num_poles = num_poles or run['metadata'].get('num_poles')
+    if not num_poles:
+        raise ValueError(f'{dest_file}: number of poles unknown')
+    # runs recorded before the delays were estimated are aligned without
+    delays = run['metadata'].get('transport_delay') or {}
+    time, arrival_delay = al.board_to_host(
+        arduino['time'], arduino['timestamp'], window, delays.get('arduino') or 0.0
+    )
+    if tolerance is None:
+        tolerance = 3 * float(np.median(np.diff(supply['time']))) if len(supply) > 1 else np.inf
+    if method == 'linear':
+        voltage = al.interpolate(time, supply['time'], supply['voltage'], tolerance)
+        current = al.interpolate(time, supply['time'], supply['current'], tolerance)
+    elif method == 'nearest':
+        index = al.merge_asof(time, supply['time'], 'nearest', tolerance)
+        voltage = np.where(index >= 0, supply['voltage'][index], np.nan)
+        current = np.where(index >= 0, supply['current'][index], np.nan)
+    else:
+        raise ValueError(f'Unknown alignment method {method!r}')
+    nearest = al.merge_asof(time, supply['time'])
+    power = electrical_power(voltage, current)
+    return {
+        'time': time,
+        'board_time': al.unwrap_board_time(arduino['timestamp']),
+        'thrust': arduino['thrust'],
+        'rpm': rpm_from_frequency(electrical_frequency(arduino['period']), num_poles),
+        'pwm': arduino['pwm'],
+        'voltage': voltage,
+        'current': current,
+        'power': power,
+        'efficiency': thrust_efficiency(arduino['thrust'], power),
+        # seconds to the nearest supply reading, and from the sample to its arrival
+        'supply_gap': np.abs(supply['time'][nearest] - time),
+        'arrival_delay': arrival_delay,
+    }
+
+
+def write_report(report, path, fmt='%.6g'):
+    names = list(report)
+    table = np.column_stack([np.asarray(report[name], dtype='f8') for name in names])
+    np.savetxt(path, table, delimiter=',', header=','.join(names), comments='', fmt=fmt)
+
+
+def find_runs(directory):
+    # dest_file of every run below directory
+    runs = []
+    for path in sorted(glob.glob(os.path.join(directory, '**', '*.csv'), recursive=True)):
+        name = os.path.splitext(path)[0]
+        if not name.endswith(RUN_SUFFIXES):
+            runs.append(name)
+    return runs
+
+
+def process_run(dest_file, num_poles=None, z=1.96, align=False):
+    # analyze_run + write_report (+ align_run), returns (dest_file, steps or error text)
+    try:
+        report = analyze_run(dest_file, num_poles, z)
+        write_report(report, dest_file + '_report.csv')
+        if align:
+            # host times need microseconds
+            write_report(align_run(dest_file, num_poles), dest_file + '_aligned.csv', '%.12g')
+        return dest_file, len(report['step'])
+    except Exception as error:
+        return dest_file, f'{type(error).__name__}: {error}'
+
+
+def analyze_directory(directory, num_poles=None, z=1.96, processes=None, align=False):
+    # every run in its own worker process, returns [(dest_file, steps or error)]
+    runs = find_runs(directory)
+    if not runs:
+        return []
+    n = len(runs)
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(process_run, runs, [num_poles] * n, [z] * n, [align] * n))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Derived metrics of recorded runs')
+    parser.add_argument('path', help='run (dest_file) or directory of runs')
+    parser.add_argument('--num-poles', type=int, help='motor poles, if not in the run metadata')
+    parser.add_argument('--z', type=float, default=1.96, help='confidence interval z value')
+    parser.add_argument('--processes', type=int, help='worker processes (default: all cores)')
+    parser.add_argument('--align', action='store_true',
+                        help='also write the sample aligned table (<run>_aligned.csv)')
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.path):
+        results = analyze_directory(args.path, args.num_poles, args.z, args.processes, args.align)
+    else:
+        results = [process_run(os.path.splitext(args.path)[0], args.num_poles, args.z, args.align)]
+    failed = 0
+    for dest_file, outcome in results:
+        if isinstance(outcome, str):
+            failed += 1
+            print(f'{dest_file}: {outcome}', file=sys.stderr)
+        else:
+            print(f'{dest_file}: {outcome} steps -> {dest_file}_report.csv')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,18 +1,72 @@
+import math
+import os
+import queue
+import sqlite3
+import sys
 import tkinter as tk
 from tkinter import ttk
 from tkinter import filedialog as fd
-from serial.tools.list_ports import comports
+from tkinter import messagebox
+from . import automated_script as a
+from . import discovery as d
+from . import instrumentation as ins
+from . import interlock as i
+from . import plots as p
+from . import results as r
+from . import storage as s
+from . import telemetry as t
 from . import views as v
-from . import models as m
+from . import workers as w
 
 
 class Application(tk.Tk):
-    def __init__(self, *args, **kwargs):
+    # extra_ports: discovery.PortIdentity entries listed next to the serial
+    # ports, e.g. the replay devices of capture.py
+    def __init__(self, *args, extra_ports=(), **kwargs):
         super().__init__(*args, **kwargs)
         self.withdraw()
         self.title('Mechtex RC Testbench')
         
         self.port_list = []
+        # ports are listed and identified on a background thread, known
+        # devices are remembered between sessions in discovery_cache
+        self.discovery_cache = os.path.join(os.path.expanduser('~'), '.mechtex_ports.json')
+        self.discovery = d.PortDiscovery(cache_file=self.discovery_cache, extra=extra_ports)
+        self.discovery_thread = None
+        # every automated run is also recorded in the results database
+        self.results_db = r.DEFAULT_PATH
+        self.store = None
+        # device I/O statistics, collected while the diagnostics panel has
+        # been opened (see instrumentation.py)
+        self.debug_panel = None
+        self.debug_ms = 500
+        
+        # device I/O runs on a worker thread, results and events from other
+        # threads are handed back to the Tk thread through this queue
+        # (see call_in_gui / poll_worker)
+        self.worker = None
+        self.engine = None
+        self.telemetry = None
+        self.gui_calls = queue.Queue()
+        self.worker_poll_ms = 16
+        # slider setpoints are coalesced, only the newest value per channel
+        # is sent, at most setpoint_rate times per second
+        self.setpoint_rate = 20.0
+        self.setpoints = w.CoalescingChannel(max_rate=self.setpoint_rate)
+        self.setpoints.done_callback = lambda key, f: self.call_in_gui(self.on_device_done, None, f)
+        # live readouts: supply polling rate while in manual mode and the
+        # dashboard refresh period, independent of the telemetry rate
+        self.telemetry_interval = 0.1
+        self.reader = None
+        self.interlock = None
+        self.dashboard_ms = 200
+        self.dashboard_formats = {
+            'voltage': '{:.2f} V',
+            'pwm': '{:.0f} us',
+            'current': '{:.3f} A',
+            'thrust': '{:.1f} gf',
+            'rpm': '{:.0f}',
+        }
         
         container = ttk.Frame(self)
         container.pack(fill='both', side='top', expand=True)
@@ -30,15 +84,25 @@ class Application(tk.Tk):
         # Configuring all setup view functionalities
         # -------------------------------------------------------------------------------
         self.setup__on_refresh()    # refresh comports on start
+        # Refresh probes the new and unidentified ports only, Re-scan All
+        # probes every free port again (the identified ones too)
         self.frames["setup"].refresh_button.config(command=self.setup__on_refresh)
+        self.frames["setup"].rescan_button.config(
+            command=lambda: self.setup__on_refresh(refresh=True)
+        )
         self.frames["setup"].source_button.config(command=self.setup__on_browse_src)
         self.frames["setup"].destination_button.config(command=self.setup__on_browse_dest)
         self.frames["setup"].button_save.config(command=self.setup__on_save)
-        self.frames["setup"].button_auto.config(state=tk.DISABLED)
+        self.frames["setup"].button_auto.config(
+            state=tk.DISABLED,
+            command=self.setup__on_auto
+        )
         self.frames["setup"].button_manual.config(
             state=tk.DISABLED,
             command=self.setup__on_manual
         )
+        self.frames["setup"].button_debug.config(command=self.debug__open)
+        self.bind('<F12>', lambda event: self.debug__open())
         
         # -------------------------------------------------------------------------------
         # Configuring all manual view functionalities
@@ -81,6 +145,11 @@ class Application(tk.Tk):
         self.frames["manual"].pwm_button.bind('<Button-1>', self.manual__on_pwm_set)
         self.frames["manual"].voltage_entry.bind('<Return>', self.manual__on_volt_set)
         self.frames["manual"].pwm_entry.bind('<Return>', self.manual__on_pwm_set)
+        # Live plot next to the dashboard
+        self.frames["manual"].plot_frame.grid_rowconfigure(0, weight=1)
+        self.frames["manual"].plot_frame.grid_columnconfigure(0, weight=1)
+        self.live_plot = p.LivePlot(self.frames["manual"].plot_frame)
+        self.live_plot.widget.grid(row=0, column=0, sticky=tk.NSEW)
         
         
         # -------------------------------------------------------------------------------
@@ -90,31 +159,130 @@ class Application(tk.Tk):
         self.frames["setup"].grid(row=0, column=0, sticky=tk.NSEW)
         self.frames["manual"].grid(row=0, column=0, sticky=tk.NSEW)
         self.show_frame("setup")
+        self.poll_worker()
+        self.manual__update_dashboard()
+        # the device threads are daemons, closing the window must not leave
+        # the motor and the supply output energized
+        self.protocol('WM_DELETE_WINDOW', self.on_close)
         
         
     def show_frame(self, cont):
         frame = self.frames[cont]
         frame.tkraise()
     
+    def on_close(self):
+        # runs the same shutdown as the Stop button and waits until the
+        # worker has written the safe state and closed the ports
+        if self.engine is not None:
+            self.engine.abort()
+            self.engine.join()
+            self.engine = None
+            self.stop_worker()
+        elif self.reader is not None:
+            self.manual__on_stop()
+        elif self.worker is not None:
+            # still opening the ports, nothing has been sent yet
+            self.stop_worker()
+        if self.worker is not None:
+            self.worker.join()
+        if self.store is not None:
+            # checkpoints the WAL into the database file
+            self.store.close()
+        self.destroy()
+    
+    # -------------------------------------------------------------------------------
+    # Device worker helpers
+    # -------------------------------------------------------------------------------
+    def start_worker(self, telemetry_interval=None):
+        self.setpoints.clear()
+        self.worker = w.DeviceWorker(
+            self.data['supply_port'],
+            self.data['arduino_port'],
+            setpoints=self.setpoints,
+            telemetry_interval=telemetry_interval
+        )
+        self.worker.start()
+    
+    def stop_worker(self):
+        self.worker.stop()
+    
+    def device_setpoint(self, device, name, value):
+        # latest value wins, see workers.CoalescingChannel
+        self.setpoints.put((device, name), value)
+    
+    def device_call(self, device, name, *args, callback=None):
+        # queues a command on the worker, callback(result) runs on the Tk thread
+        future = self.worker.submit(device, name, *args)
+        future.add_done_callback(lambda f: self.call_in_gui(self.on_device_done, callback, f))
+        return future
+    
+    def call_in_gui(self, function, *args):
+        # safe from any thread, function(*args) runs on the Tk thread
+        self.gui_calls.put((function, args))
+    
+    def poll_worker(self):
+        # rescheduled first, a failing handler must not stop the polling
+        self.after(self.worker_poll_ms, self.poll_worker)
+        while True:
+            try:
+                function, args = self.gui_calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                function(*args)
+            except Exception:
+                # reported like any other Tk callback error, the calls
+                # queued behind it still run
+                self.report_callback_exception(*sys.exc_info())
+    
+    def on_device_done(self, callback, future):
+        if future.exception() is not None:
+            self.on_device_error(future.exception())
+        elif callback is not None:
+            callback(future.result())
+    
+    def on_device_error(self, error):
+        messagebox.showerror('Device error', str(error))
+    
     # -------------------------------------------------------------------------------
     # Functions for setup view widgets
     # -------------------------------------------------------------------------------
-    def setup__on_refresh(self):
-        self.port_list = [port.device for port in comports()]
-        self.frames["setup"].supply_port.set('')
-        self.frames["setup"].arduino_port.set('')
-        self.frames["setup"].supply_port_menu['menu'].delete(0, 'end')
-        self.frames["setup"].arduino_port_menu['menu'].delete(0, 'end')
-        for choice in self.port_list:
-            self.frames["setup"].supply_port_menu['menu'].add_command(
-                label=choice,
-                command=tk._setit(self.frames["setup"].supply_port, choice)
-            )
-            self.frames["setup"].arduino_port_menu['menu'].add_command(
-                label=choice,
-                command=tk._setit(self.frames["setup"].arduino_port, choice)
-            )
-        pass
+    def setup__on_refresh(self, refresh=False):
+        if self.discovery_thread is not None and self.discovery_thread.is_alive():
+            return
+        # ports held by a running worker cannot be probed
+        skip = ()
+        if self.worker is not None and self.worker.is_alive():
+            skip = (self.data['supply_port'], self.data['arduino_port'])
+        self.frames["setup"].refresh_button.config(text='Scanning...', state='disabled')
+        self.frames["setup"].rescan_button.config(state='disabled')
+        self.discovery_thread = d.DiscoveryThread(
+            self.discovery,
+            lambda result: self.call_in_gui(self.setup__on_ports_found, result),
+            skip=skip,
+            refresh=refresh
+        )
+        self.discovery_thread.start()
+    
+    def setup__on_ports_found(self, result):
+        self.frames["setup"].refresh_button.config(text='Refresh Ports', state='normal')
+        self.frames["setup"].rescan_button.config(state='normal')
+        if isinstance(result, Exception):
+            messagebox.showerror('Port discovery', str(result))
+            return
+        self.port_list = [port.device for port in result]
+        for kind, variable, menu in (
+            ('supply', self.frames["setup"].supply_port, self.frames["setup"].supply_port_menu),
+            ('arduino', self.frames["setup"].arduino_port, self.frames["setup"].arduino_port_menu)
+        ):
+            menu['menu'].delete(0, 'end')
+            for port in result:
+                label = port.device if port.identity is None else f'{port.device} ({port.identity})'
+                menu['menu'].add_command(label=label, command=tk._setit(variable, port.device))
+            # keep a still valid choice, otherwise pick the identified device
+            if variable.get() not in self.port_list:
+                found = [port.device for port in result if port.kind == kind]
+                variable.set(found[0] if found else '')
         
     
     def setup__on_browse_src(self):
@@ -126,7 +294,6 @@ class Application(tk.Tk):
     def setup__on_save(self):
         # check if all com ports are different
         self.data = self.frames["setup"].getData()
-        print(self.data)
         self.frames["setup"].button_auto.config(state=tk.NORMAL)
         self.frames["setup"].button_manual.config(state=tk.NORMAL)
     
@@ -136,36 +303,180 @@ class Application(tk.Tk):
         self.frames["setup"].button_manual.config(state=tk.DISABLED)
     
     def setup__on_auto(self):
+        try:
+            plan = a.load_test_plan(self.data['source_file'], self.data)
+        except (OSError, ValueError) as error:
+            messagebox.showerror('Test plan', str(error))
+            return
+        try:
+            if self.store is None:
+                self.store = r.ResultStore(self.results_db)
+            writer = s.RunWriter(
+                self.data['dest_file'],
+                a.StepResult._fields,
+                metadata=self.data,
+                store=self.store
+            )
+        except (OSError, sqlite3.Error) as error:
+            messagebox.showerror('Destination file', str(error))
+            return
+        self.start_worker()
+        self.telemetry = t.TelemetryBuffer(self.data['num_poles'])
+        try:
+            self.engine = a.SweepEngine(
+                self.data,
+                plan=plan,
+                worker=self.worker,
+                writer=writer,
+                telemetry=self.telemetry,
+                on_step=lambda result, total: self.call_in_gui(self.auto__on_step, result, total),
+                on_finish=lambda error: self.call_in_gui(self.auto__on_finish, error)
+            )
+        except ValueError as error:
+            writer.close()
+            self.stop_worker()
+            messagebox.showerror('Automated testing', str(error))
+            return
+        self.engine.start()
+        self.live_plot.start(self.telemetry)
+        
         self.frames["setup"].button_auto.config(state=tk.DISABLED)
         self.frames["setup"].button_manual.config(state=tk.DISABLED)
+        self.show_frame("manual")
+        self.frames["manual"].back_button.config(state=tk.DISABLED)
+        self.frames["manual"].start_button.config(state=tk.DISABLED)
+        self.frames["manual"].stop_button.config(state=tk.NORMAL)
+    
+    # -------------------------------------------------------------------------------
+    # Functions for automated testing
+    # -------------------------------------------------------------------------------
+    def auto__on_step(self, result, total):
+        self.title(f'Mechtex RC Testbench - step {result.step}/{total}')
+    
+    def auto__on_finish(self, error):
+        self.engine = None
+        self.live_plot.stop()
+        self.stop_worker()
+        if ins.active() is not None:
+            try:
+                ins.active().export(os.path.splitext(self.data['dest_file'])[0] + '_stats.json')
+            except OSError as export_error:
+                messagebox.showerror('Diagnostics', str(export_error))
+        self.title('Mechtex RC Testbench')
+        self.frames["manual"].back_button.config(state=tk.NORMAL)
+        self.frames["manual"].stop_button.config(state=tk.DISABLED)
+        self.frames["manual"].start_button.config(state=tk.NORMAL)
+        if error is not None:
+            messagebox.showerror('Automated testing stopped', str(error))
+    
+    # -------------------------------------------------------------------------------
+    # Functions for the diagnostics panel
+    # -------------------------------------------------------------------------------
+    def debug__open(self):
+        if self.debug_panel is not None:
+            self.debug_panel.lift()
+            return
+        if ins.active() is None:
+            ins.enable()
+        self.debug_panel = v.DebugPanel(self)
+        self.debug_panel.reset_button.config(command=self.debug__on_reset)
+        self.debug_panel.export_button.config(command=self.debug__on_export)
+        self.debug_panel.protocol('WM_DELETE_WINDOW', self.debug__on_close)
+        self.debug__update()
+    
+    def debug__update(self):
+        if self.debug_panel is None:
+            return
+        self.debug_panel.show(ins.active().snapshot())
+        self.after(self.debug_ms, self.debug__update)
+    
+    def debug__on_reset(self):
+        ins.enable()
+        for tree in (self.debug_panel.latency_tree, self.debug_panel.counter_tree):
+            if tree.get_children():
+                tree.delete(*tree.get_children())
+    
+    def debug__on_export(self):
+        path = fd.asksaveasfilename(defaultextension='.json', filetypes=[('JSON', '*.json')])
+        if path:
+            ins.active().export(path)
+    
+    def debug__on_close(self):
+        # statistics keep being collected until the application exits
+        self.debug_panel.destroy()
+        self.debug_panel = None
     
     # -------------------------------------------------------------------------------
     # Functions for manual view widgets
     # -------------------------------------------------------------------------------
     def manual__on_start(self):
+        try:
+            i.require_limits(self.data)
+        except ValueError as error:
+            messagebox.showerror('Manual testing', str(error))
+            return
         
-        # Open power supply port
-        self.supply = m.PowerSupply(self.data['supply_port'])
-        # Set OVP, current limit
-        self.supply.setVoltage(0)
-        self.supply.turnOutputON()
+        # Open the ports (on the worker thread), nothing is queued until
+        # they are open
+        self.start_worker(telemetry_interval=self.telemetry_interval)
+        self.frames["manual"].back_button.config(state=tk.DISABLED)
+        self.frames["manual"].start_button.config(state=tk.DISABLED)
+        self.manual__on_worker_ready()
+    
+    def manual__on_worker_ready(self):
+        if not self.worker.ready.is_set():
+            self.after(self.worker_poll_ms, self.manual__on_worker_ready)
+            return
+        if self.worker.error is not None:
+            # one error for the failed port, the page stays stopped
+            self.frames["manual"].back_button.config(state=tk.NORMAL)
+            self.frames["manual"].start_button.config(state=tk.NORMAL)
+            messagebox.showerror('Manual testing', str(self.worker.error))
+            return
+        # Set OVP, current limit, the interlock watches every sample
+        self.interlock = i.Interlock(
+            self.worker,
+            self.data,
+            on_trip=lambda error: self.call_in_gui(self.manual__on_trip, error)
+        )
+        self.worker.sinks.append(self.interlock)
+        self.interlock.start()
+        for future in self.interlock.programLimits():
+            future.add_done_callback(lambda f: self.call_in_gui(self.on_device_done, None, f))
+        self.device_call('arduino', 'setPWM', 1000)
+        self.device_call('supply', 'setVoltage', 0)
+        self.device_call('supply', 'turnOutputON')
+        # Live telemetry for the dashboard and plot
+        self.telemetry = t.TelemetryBuffer(self.data['num_poles'])
+        self.worker.sinks.append(self.telemetry)
+        self.reader = w.ArduinoReader(self.worker)
+        self.reader.start()
+        self.live_plot.start(self.telemetry)
         
         # Update GUI
-        self.frames["manual"].back_button.config(state=tk.DISABLED)
         for widget in self.frames["manual"].pwm_frame.winfo_children():
             widget.config(state=tk.NORMAL)
         for widget in self.frames["manual"].voltage_frame.winfo_children():
             widget.config(state=tk.NORMAL)
         self.frames["manual"].stop_button.config(state=tk.NORMAL)
-        self.frames["manual"].start_button.config(state=tk.DISABLED)
     
     def manual__on_stop(self):
+        if self.engine is not None:
+            # the engine shuts the devices down and reports via auto__on_finish
+            self.engine.abort()
+            return
         self.current_entry_voltage.set(0)
         self.current_slider_voltage.set(0)
         self.current_entry_pwm.set(1000)
         self.current_slider_pwm.set(1000)
-        self.supply.setVoltage(0)
-        self.supply.close()
+        self.setpoints.clear()
+        self.reader.stop()
+        self.reader = None
+        self.interlock.stop()
+        self.live_plot.stop()
+        self.device_call('arduino', 'setPWM', 1000)
+        self.device_call('supply', 'setVoltage', 0)
+        self.stop_worker()
         self.frames["manual"].back_button.config(state=tk.NORMAL)
         self.frames["manual"].stop_button.config(state=tk.DISABLED)
         self.frames["manual"].start_button.config(state=tk.NORMAL)
@@ -174,9 +485,28 @@ class Application(tk.Tk):
         for widget in self.frames["manual"].voltage_frame.winfo_children():
             widget.config(state=tk.DISABLED)
     
+    def manual__on_trip(self, error):
+        # the devices are already cut off, this only resets the page
+        if self.engine is None and self.reader is not None:
+            self.manual__on_stop()
+        messagebox.showerror('Safety interlock', str(error))
+    
     def manual__on_back(self):
         self.show_frame("setup")
     
+    def manual__update_dashboard(self):
+        # single fixed-rate timer, shows the average of the last num_readings
+        # values of every channel
+        self.after(self.dashboard_ms, self.manual__update_dashboard)
+        if self.telemetry is None:
+            return
+        window = max(1, self.data['num_readings'])
+        text = {}
+        for name, fmt in self.dashboard_formats.items():
+            value = self.telemetry[name].mean(window)
+            text[name] = '' if math.isnan(value) else fmt.format(value)
+        self.frames["manual"].updateDashboard(text)
+    
     def manual__v_slider_changed(self, event):
         value = self.current_slider_voltage.get()
         new_value = (value // 2.5) * 2.5
@@ -185,7 +515,7 @@ class Application(tk.Tk):
         self.old_voltage = new_value
         self.current_slider_voltage.set(new_value)
         self.current_entry_voltage.set(new_value)
-        self.supply.setVoltage(new_value)
+        self.device_setpoint('supply', 'setVoltage', new_value)
         self.frames["manual"].voltage_slider.focus()
     
     def manual__p_slider_changed(self, event):
@@ -196,7 +526,7 @@ class Application(tk.Tk):
         self.old_pwm = new_value
         self.current_slider_pwm.set(new_value)
         self.current_entry_pwm.set(new_value)
-        # !!! Send PWM to Arduino here !!!
+        self.device_setpoint('arduino', 'setPWM', new_value)
         self.frames["manual"].pwm_slider.focus()
     
     def manual__on_pwm_set(self, event):
@@ -207,7 +537,7 @@ class Application(tk.Tk):
             return
         self.current_slider_pwm.set(value)
         self.old_pwm = value
-        # !!! Send PWM to Arduino Here !!!
+        self.device_setpoint('arduino', 'setPWM', value)
     
     def manual__on_volt_set(self, event):
         value = self.current_entry_voltage.get()
@@ -217,5 +547,5 @@ class Application(tk.Tk):
             return
         self.current_slider_voltage.set(value)
         self.old_voltage = value
-        self.supply.setVoltage(value)
+        self.device_setpoint('supply', 'setVoltage', value)
     
\ No newline at end of file
@@ -0,0 +1,160 @@
+import asyncio
+import serial
+import time
+from . import models as m
+
+# asyncio variant of the device API (POSIX, selector event loop)
+#
+# The ports are opened and configured by the regular models.PowerSupply /
+# models.Arduino classes. Their file descriptors (already non-blocking) are
+# then registered with the event loop: incoming bytes are drained into the
+# device's receive buffer as soon as they arrive and waiting coroutines are
+# woken up, so waiting on the supply and on the Arduino overlaps.
+#
+#   supply = await AsyncPowerSupply.open(data['supply_port'])
+#   arduino = await AsyncArduino.open(data['arduino_port'])
+#   await setStep(supply, arduino, 12.0, 1500)
+#   readings, samples = await acquire(supply, arduino, data['num_readings'])
+
+
+class AsyncDevice:
+
+    def __init__(self, device):
+        self.device = device
+        self.loop = asyncio.get_running_loop()
+        self.error = None
+        self._data = asyncio.Event()
+        self.loop.add_reader(device.fileno(), self._onReadable)
+
+    def close(self):
+        self.loop.remove_reader(self.device.fileno())
+        self.device.close()
+
+    # Private methods
+    def _onReadable(self):
+        try:
+            self.device._fillBuffer()
+        except serial.SerialException as error:
+            # e.g. USB unplugged, reported to the waiting coroutine
+            self.error = error
+            self.loop.remove_reader(self.device.fileno())
+        self._data.set()
+
+    async def _waitData(self, timeout):
+        if self.error is not None:
+            raise self.error
+        self._data.clear()
+        await asyncio.wait_for(self._data.wait(), timeout)
+        if self.error is not None:
+            raise self.error
+
+
+class AsyncPowerSupply(AsyncDevice):
+
+    @classmethod
+    async def open(cls, comPort, **kwargs):
+        # the blocking open / *RST runs in the default executor
+        device = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: m.PowerSupply(comPort, **kwargs)
+        )
+        return cls(device)
+
+    async def query(self, command):
+        self.device._sendCommand(command)
+        return await self._readLine()
+
+    async def getID(self):
+        return await self.query('*IDN?')
+
+    async def turnOutputON(self):
+        self.device._sendCommand('OUTP ON')
+
+    async def turnOutputOFF(self):
+        self.device._sendCommand('OUTP OFF')
+
+    # setpoints are written through the device's shadow registers
+    async def setOVP(self, value):
+        self.device.setOVP(value)
+
+    async def setVoltage(self, value):
+        self.device.setVoltage(value)
+
+    async def setCurrentLimit(self, value):
+        self.device.setCurrentLimit(value)
+
+    async def measure(self, fields=('VOLT', 'CURR')):
+        reply = await self.query(self.device._measureCommand(fields))
+        return self.device._parseMeasurement(fields, reply)
+
+    # Private methods
+    async def _readLine(self):
+        timeout = self.device.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            line = self.device._popLine()
+            if line is not None:
+                return line
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                if remaining is not None and remaining <= 0:
+                    raise asyncio.TimeoutError
+                await self._waitData(remaining)
+            except asyncio.TimeoutError:
+                raise serial.SerialTimeoutException(
+                    f'Incomplete reply from power supply: {bytes(self.device._rxBuffer)!r}'
+                ) from None
+
+
+class AsyncArduino(AsyncDevice):
+
+    @classmethod
+    async def open(cls, comPort, **kwargs):
+        # the blocking open / handshake runs in the default executor
+        device = await asyncio.get_running_loop().run_in_executor(
+            None, lambda: m.Arduino(comPort, **kwargs)
+        )
+        return cls(device)
+
+    async def setPWM(self, value):
+        self.device.setPWM(value)
+
+    async def startStream(self, rate=1000):
+        self.device.startStream(rate)
+
+    async def stopStream(self):
+        self.device.stopStream()
+
+    async def readSamples(self, timeout=1.0):
+        # waits until at least one sample is in, returns all complete ones
+        deadline = time.monotonic() + timeout
+        while True:
+            samples = self.device._pendingSamples + self.device._parseFrames()
+            self.device._pendingSamples = []
+            if samples:
+                return samples
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise serial.SerialTimeoutException('No samples from Arduino')
+            try:
+                await self._waitData(remaining)
+            except asyncio.TimeoutError:
+                raise serial.SerialTimeoutException('No samples from Arduino') from None
+
+
+async def setStep(supply, arduino, voltage, pwm):
+    await asyncio.gather(supply.setVoltage(voltage), arduino.setPWM(pwm))
+
+
+async def acquire(supply, arduino, num_readings, fields=('VOLT', 'CURR')):
+    # num_readings supply measurements and at least num_readings Arduino
+    # samples, both collected at the same time
+    async def readSupply():
+        return [await supply.measure(fields) for i in range(num_readings)]
+
+    async def readArduino():
+        samples = []
+        while len(samples) < num_readings:
+            samples += await arduino.readSamples()
+        return samples
+
+    return await asyncio.gather(readSupply(), readArduino())
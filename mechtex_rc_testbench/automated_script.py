@@ -1,14 +1,291 @@
+import csv
+import threading
+import time
+from collections import namedtuple
+from . import interlock as i
+from . import settling as st
+from . import telemetry as t
+from . import workers as w
 
-def automated_script():
-    
-    # Get the csv list from input file
-    # Open all ports
-    # send averaging number to arduino
-    # start threads
-        # main thread: GUI (no need to start)
-        # thread1 : power supply, arduino
-        # thread2 : matplotlib
-    
-    
-    
-    pass
\ No newline at end of file
+# Automated sweep
+#
+# Get the csv list from input file
+# Open all ports
+# send averaging number to arduino
+# start threads
+    # main thread: GUI (no need to start)
+    # thread1 : power supply, arduino (workers.DeviceWorker, workers.ArduinoReader)
+    # interlock: checks every sample against the limits (interlock.Interlock)
+    # thread2 : matplotlib
+    # SweepEngine: steps through the plan and averages the readings
+#
+# The source file has one step per row: voltage (V), pwm (us) and an optional
+# dwell (s) to wait before taking readings. A header row naming the columns
+# 'voltage', 'pwm' and 'dwell' is optional. A .json source file describes an
+# adaptive plan instead (planner.AdaptivePlan).
+
+
+# One row of the test plan
+PlanStep = namedtuple('PlanStep', ['voltage', 'pwm', 'dwell'], defaults=[None])
+
+# Averaged readings of one step, current in A, thrust in gf. start and end
+# are the host times (time.monotonic) of the first and last reading averaged,
+# they locate the step in the raw telemetry files (see analysis.py)
+StepResult = namedtuple('StepResult', [
+    'step', 'voltage_set', 'pwm_set',
+    'voltage', 'current', 'thrust', 'rpm', 'pwm',
+    'start', 'end',
+])
+
+
+def load_test_plan(path, data=None):
+    # data (the setup data) is needed by adaptive plans only
+    if path.lower().endswith('.json'):
+        from . import planner
+        return planner.AdaptivePlan.fromFile(path, data)
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        # (line number, cells) of every row that is not blank
+        rows = [(reader.line_num, row) for row in reader if any(cell.strip() for cell in row)]
+    if not rows:
+        raise ValueError(f'Test plan {path} is empty')
+    columns = {'voltage': 0, 'pwm': 1, 'dwell': 2}
+    header = [cell.strip().lower() for cell in rows[0][1]]
+    if 'voltage' in header and 'pwm' in header:
+        columns = {name: header.index(name) for name in columns if name in header}
+        rows = rows[1:]
+    plan = []
+    for line, row in rows:
+        try:
+            dwell = None
+            if 'dwell' in columns and columns['dwell'] < len(row) and row[columns['dwell']].strip():
+                dwell = float(row[columns['dwell']])
+            plan.append(PlanStep(float(row[columns['voltage']]), float(row[columns['pwm']]), dwell))
+        except (IndexError, ValueError):
+            raise ValueError(
+                f'Test plan {path} row {line}: expected voltage, pwm and optionally dwell, '
+                f'got {",".join(row)!r}'
+            ) from None
+    return plan
+
+
+class StepCollector:
+    # Telemetry sink used by the sweep engine: stores every sample in the
+    # telemetry ring buffers and wakes the engine up when new readings arrived
+
+    def __init__(self, telemetry):
+        self.telemetry = telemetry
+        self.condition = threading.Condition()
+
+    def __call__(self, kind, timestamp, payload):
+        self.telemetry(kind, timestamp, payload)
+        self.notify()
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+
+class SweepEngine(threading.Thread):
+    # Runs the test plan on its own thread. Device I/O happens on the device
+    # worker, the Arduino stream is read by an ArduinoReader, so supply and
+    # Arduino are sampled concurrently while this thread only waits on them.
+    #
+    #   engine = SweepEngine(data, on_step=print)
+    #   engine.start()
+    #
+    # on_step(StepResult, total_steps) and on_finish(error or None) are called
+    # from this thread. A storage.RunWriter passed as writer records every
+    # sample and step result while the sweep runs and is closed at the end.
+    # Readings are averaged from the telemetry ring buffers, pass a
+    # telemetry.TelemetryBuffer to share them with the dashboard.
+    #
+    # With settling (the default) readings start as soon as thrust, RPM and
+    # current are steady (settling.SettlingDetector), the step's dwell is then
+    # only the longest wait. settling=False waits the full dwell every step,
+    # a SettlingDetector instance sets custom thresholds.
+
+    def __init__(self, data, plan=None, worker=None, on_step=None, on_finish=None,
+                 writer=None, telemetry=None, settle_time=1.0, sample_timeout=5.0,
+                 telemetry_interval=0.0, settling=True):
+        super().__init__(name='sweep-engine', daemon=True)
+        i.require_limits(data)
+        self.data = data
+        self.plan = plan if plan is not None else load_test_plan(data['source_file'], data)
+        self.num_readings = max(1, data['num_readings'])
+        self.on_step = on_step
+        self.on_finish = on_finish
+        self.writer = writer
+        self.settle_time = settle_time
+        self.sample_timeout = sample_timeout
+        self.results = []
+        # seconds from the set points to the start of the readings, per step
+        self.settle_times = []
+        if settling is True:
+            settling = st.SettlingDetector(data['num_poles'])
+        self.settling = settling or None
+
+        # an external worker (GUI) stays running afterwards, our own is stopped
+        self.owns_worker = worker is None
+        if worker is None:
+            worker = w.DeviceWorker(
+                data['supply_port'],
+                data['arduino_port'],
+                telemetry_interval=telemetry_interval
+            )
+        elif worker.telemetry_interval is None:
+            worker.telemetry_interval = telemetry_interval
+        self.worker = worker
+        self.reader = w.ArduinoReader(worker)
+        if telemetry is None:
+            telemetry = t.TelemetryBuffer(
+                data['num_poles'],
+                capacity=max(65536, 4 * self.num_readings)
+            )
+        self.telemetry = telemetry
+        self.collector = StepCollector(telemetry)
+        self.interlock = i.Interlock(worker, data, on_trip=lambda error: self.collector.notify())
+        self._abort = threading.Event()
+
+    def abort(self):
+        self._abort.set()
+        self.collector.notify()
+
+    def run(self):
+        error = None
+        self.interlock.start()
+        self.worker.sinks.append(self.interlock)
+        if self.settling is not None:
+            self.worker.sinks.append(self.settling)
+        self.worker.sinks.append(self.collector)
+        if self.writer is not None:
+            self.worker.sinks.append(self.writer)
+        try:
+            if self.owns_worker:
+                self.worker.start()
+            self.worker.ready.wait()
+            if self.worker.error is not None:
+                raise self.worker.error
+            self._prepare()
+            self.reader.start()
+            for index, step in enumerate(self.plan):
+                if self._abort.is_set():
+                    break
+                result = self._runStep(index, step)
+                if result is None:
+                    break
+                self.results.append(result)
+                if hasattr(self.plan, 'addResult'):
+                    # adaptive plans pick the next points from the results
+                    self.plan.addResult(step, result)
+                if self.writer is not None:
+                    self.writer.writeStep(result)
+                if self.on_step is not None:
+                    self.on_step(result, len(self.plan))
+        except Exception as exc:
+            error = exc
+        finally:
+            self._shutdown(error)
+        if self.on_finish is not None:
+            self.on_finish(error)
+
+    # Private methods
+    def _prepare(self):
+        self.worker.call('arduino', 'setPWM', 1000)
+        self.worker.call('arduino', 'setAveraging', 1)
+        for future in self.interlock.programLimits():
+            future.result()
+        self.worker.call('supply', 'setVoltage', 0)
+        self.worker.call('supply', 'turnOutputON')
+
+    def _runStep(self, index, step):
+        i.check_limits(self.data, voltage=step.voltage)
+        if not 1000 <= step.pwm <= 2000:
+            raise ValueError(f'Step {index + 1}: PWM {step.pwm} outside 1000-2000 us')
+        self.worker.call('supply', 'setVoltage', step.voltage)
+        self.worker.call('arduino', 'setPWM', step.pwm)
+
+        dwell = self.settle_time if step.dwell is None else step.dwell
+        started = time.monotonic()
+        if self.settling is None:
+            if self._abort.wait(dwell):
+                return None
+        else:
+            self.settling.reset()
+            with self.collector.condition:
+                self.collector.condition.wait_for(
+                    lambda: self._abort.is_set() or self.interlock.violation is not None
+                    or self.settling.settled(),
+                    timeout=dwell
+                )
+            if self._abort.is_set():
+                return None
+        self.settle_times.append(time.monotonic() - started)
+        self._raiseViolation()
+
+        # wait for num_readings fresh readings from both devices
+        telemetry = self.telemetry
+        marks = {source: telemetry.count(source) for source in telemetry.SOURCES}
+        with self.collector.condition:
+            complete = self.collector.condition.wait_for(
+                lambda: self._abort.is_set() or self.interlock.violation is not None or all(
+                    telemetry.count(source) - mark >= self.num_readings
+                    for source, mark in marks.items()
+                ),
+                timeout=self.sample_timeout
+            )
+        self._raiseViolation()
+        if self._abort.is_set():
+            return None
+        if not complete:
+            received = {source: telemetry.count(source) - mark for source, mark in marks.items()}
+            raise TimeoutError(
+                f'Step {index + 1}: got {received["supply"]} supply and {received["arduino"]} '
+                f'Arduino readings of {self.num_readings} in {self.sample_timeout} s'
+            )
+
+        n = self.num_readings
+        times = [telemetry.times[source].window(n) for source in telemetry.SOURCES]
+        return StepResult(
+            step=index + 1,
+            voltage_set=step.voltage,
+            pwm_set=step.pwm,
+            voltage=float(telemetry['voltage'].mean(n)),
+            current=float(telemetry['current'].mean(n)),
+            thrust=float(telemetry['thrust'].mean(n)),
+            rpm=float(telemetry['rpm'].mean(n)),
+            pwm=float(telemetry['pwm'].mean(n)),
+            start=float(min(window[0] for window in times)),
+            end=float(max(window[-1] for window in times)),
+        )
+
+    def _raiseViolation(self):
+        if self.interlock.violation is not None:
+            raise self.interlock.violation
+
+    def _shutdown(self, error=None):
+        # motor off first, then the supply
+        self.reader.stop()
+        self.worker.submit('arduino', 'setPWM', 1000)
+        self.worker.submit('supply', 'setVoltage', 0)
+        self.worker.submit('supply', 'turnOutputOFF')
+        if self.reader.is_alive():
+            self.reader.join()
+        self.interlock.stop()
+        for sink in (self.interlock, self.settling, self.collector, self.writer):
+            if sink in self.worker.sinks:
+                self.worker.sinks.remove(sink)
+        if self.writer is not None:
+            # used by analysis.align_run
+            self.writer.annotate(transport_delay=self.worker.transportDelays())
+            self.writer.close(error)
+        if self.owns_worker:
+            self.worker.stop()
+            self.worker.join()
+
+
+def automated_script(data, on_step=None, on_finish=None, **kwargs):
+    # starts a sweep of data['source_file'] in the background, returns the engine
+    engine = SweepEngine(data, on_step=on_step, on_finish=on_finish, **kwargs)
+    engine.start()
+    return engine
@@ -0,0 +1,356 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from . import automated_script as a
+from . import interlock as i
+from . import models as m
+from . import settling as st
+from . import storage as s
+from . import telemetry as t
+from . import workers as w
+
+# Benchmark suite
+#
+# latency     set / query round trips of the power supply. The "legacy" cases
+#             reproduce the old fixed 50 ms sleep + byte-by-byte read, the
+#             "framed" cases use the terminator aware transport in models.py.
+# throughput  sustained supply readings and Arduino samples per second
+#             through the device worker and the Arduino reader
+# sweep       wall time of a full automated sweep
+# interlock   delay between an over-limit sample arriving and the cut-off
+#             commands being written
+# replay      the Arduino stream of a capture (capture.py) through the
+#             acquisition pipeline (reader, telemetry, settling, averaging,
+#             raw file writer) as fast as the pipeline takes it
+#
+#   python -m mechtex_rc_testbench.benchmark COM11 --arduino COM12
+#   python -m mechtex_rc_testbench.benchmark --simulate --latency 0.002 --json out.json
+#   python -m mechtex_rc_testbench.benchmark --simulate --compare baseline.json
+#   python -m mechtex_rc_testbench.benchmark --replay field.mtxcap
+#
+# With --simulate the devices from simulation.py are used, no hardware needed.
+# --compare exits with status 1 if any metric is worse than the baseline by
+# more than --tolerance.
+
+
+def legacy_set(supply, command):
+    supply.write(command.encode('ascii') + supply.terminator)
+    time.sleep(0.05)
+
+
+def legacy_query(supply, command):
+    supply.write(command.encode('ascii') + supply.terminator)
+    received_message = b''
+    time.sleep(0.05)
+    while supply.inWaiting():
+        received_message += supply.read()
+    return received_message.decode('ascii')
+
+
+def framed_set(supply, command):
+    supply._sendCommand(command)
+
+
+def framed_query(supply, command):
+    return supply._query(command)
+
+
+def time_calls(function, count):
+    # returns per-call latencies in ms
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        function()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def summarize(latencies):
+    ordered = sorted(latencies)
+    return {
+        'n': len(ordered),
+        'mean': statistics.fmean(ordered),
+        'median': statistics.median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+        'max': ordered[-1],
+    }
+
+
+def run_latency_benchmark(supply, count=100):
+    # set commands go through *OPC? so both modes measure until the
+    # instrument has actually processed the command
+    cases = {
+        'legacy set': lambda: (legacy_set(supply, 'VOLT 0'), legacy_query(supply, '*OPC?')),
+        'legacy query': lambda: legacy_query(supply, 'MEAS:VOLT?'),
+        'framed set': lambda: (framed_set(supply, 'VOLT 0'), framed_query(supply, '*OPC?')),
+        'framed query': lambda: framed_query(supply, 'MEAS:VOLT?'),
+        'framed V+I': lambda: (supply.getActualVoltage(), supply.getActualCurrent()),
+        'batched V+I': lambda: supply.measure(['VOLT', 'CURR']),
+    }
+    results = {}
+    for name, function in cases.items():
+        supply.reset_input_buffer()
+        results[name] = summarize(time_calls(function, count))
+    return results
+
+
+def run_throughput_benchmark(supply_port, arduino_port, num_poles=14, duration=5.0):
+    worker = w.DeviceWorker(supply_port, arduino_port, telemetry_interval=0.0)
+    telemetry = t.TelemetryBuffer(num_poles)
+    worker.sinks.append(telemetry)
+    reader = w.ArduinoReader(worker)
+    worker.start()
+    worker.ready.wait()
+    if worker.error is not None:
+        raise worker.error
+    reader.start()
+    try:
+        # let the stream get going before counting
+        time.sleep(0.5)
+        start = {source: telemetry.count(source) for source in telemetry.SOURCES}
+        time.sleep(duration)
+        return {
+            f'{source} samples/s': (telemetry.count(source) - start[source]) / duration
+            for source in telemetry.SOURCES
+        }
+    finally:
+        reader.stop()
+        reader.join()
+        worker.stop()
+        worker.join()
+
+
+def run_sweep_benchmark(supply_port, arduino_port, num_poles=14, steps=10,
+                        num_readings=20, settle_time=0.1):
+    data = {
+        'num_poles': num_poles,
+        'num_readings': num_readings,
+        'supply_port': supply_port,
+        'arduino_port': arduino_port,
+        'max_voltage': 80.0,
+        'max_current': 1e6,
+        'max_thrust': 1e6,
+        'max_rpm': 1e6,
+        'source_file': '',
+        'dest_file': '',
+    }
+    plan = [a.PlanStep(12.0, 1000 + 1000 * (i + 1) / steps) for i in range(steps)]
+    errors = []
+    engine = a.SweepEngine(data, plan=plan, settle_time=settle_time, on_finish=errors.append)
+    start = time.perf_counter()
+    engine.start()
+    engine.join()
+    wall_time = time.perf_counter() - start
+    if errors[0] is not None:
+        raise errors[0]
+    return {'sweep wall time (s)': wall_time, 'sweep time per step (s)': wall_time / steps}
+
+
+def run_interlock_benchmark(supply_port, arduino_port, num_poles=14, trips=5, max_thrust=100.0):
+    # runs the motor into max_thrust `trips` times, each with a fresh worker
+    data = {
+        'num_poles': num_poles,
+        'max_voltage': 80.0,
+        'max_current': 1e6,
+        'max_thrust': max_thrust,
+        'max_rpm': 1e6,
+    }
+    latencies = []
+    for trip in range(trips):
+        # let the motor spin down from the previous run
+        time.sleep(1.0)
+        worker = w.DeviceWorker(supply_port, arduino_port, telemetry_interval=0.0)
+        interlock = i.Interlock(worker, data)
+        worker.sinks.append(interlock)
+        reader = w.ArduinoReader(worker)
+        interlock.start()
+        worker.start()
+        worker.ready.wait()
+        if worker.error is not None:
+            raise worker.error
+        reader.start()
+        try:
+            for future in interlock.programLimits():
+                future.result()
+            worker.call('supply', 'setVoltage', 12.0)
+            worker.call('supply', 'turnOutputON')
+            worker.call('arduino', 'setPWM', 1500)
+            deadline = time.monotonic() + 5.0
+            while interlock.violation is None and time.monotonic() < deadline:
+                time.sleep(0.01)
+            if interlock.trip_latency is None:
+                raise TimeoutError(f'Interlock did not trip at {max_thrust} gf')
+            latencies.append(interlock.trip_latency * 1000)
+        finally:
+            interlock.stop()
+            reader.stop()
+            reader.join()
+            worker.stop()
+            worker.join()
+    return {
+        'interlock trip median (ms)': statistics.median(latencies),
+        'interlock trip max (ms)': max(latencies),
+    }
+
+
+def run_replay_benchmark(path, num_poles=14, num_readings=20, idle=0.5):
+    # the capture's supply answers the worker as fast as possible, the
+    # stream ends when no sample came for `idle` seconds
+    from . import capture
+    from . import simulation
+    channels = capture.read_capture(path)
+    supply = simulation.ReplayDevice(
+        capture.find_channel(channels, 'PowerSupply'), simulation.ReplayClock(None), gating=False
+    )
+    arduino = simulation.ReplayDevice(capture.find_channel(channels, 'Arduino'))
+    supply.start()
+    arduino.start()
+    telemetry = t.TelemetryBuffer(num_poles)
+
+    def average(kind, timestamp, payload):
+        # what the sweep engine computes for a step, after every batch
+        for channel in ('voltage', 'current') if kind == 'supply' else ('thrust', 'rpm', 'pwm'):
+            telemetry[channel].mean(num_readings)
+
+    with tempfile.TemporaryDirectory() as directory:
+        writer = s.RunWriter(os.path.join(directory, 'replay'), a.StepResult._fields)
+        worker = w.DeviceWorker(supply.port, arduino.port)
+        worker.sinks += [telemetry, st.SettlingDetector(num_poles), average, writer]
+        reader = w.ArduinoReader(worker)
+        worker.start()
+        worker.ready.wait()
+        try:
+            if worker.error is not None:
+                raise worker.error
+            start = time.perf_counter()
+            reader.start()
+            count, last = 0, start
+            while not arduino.finished() or time.perf_counter() - last < idle:
+                time.sleep(0.01)
+                if telemetry.count('arduino') != count:
+                    count, last = telemetry.count('arduino'), time.perf_counter()
+        finally:
+            reader.stop()
+            reader.join()
+            worker.stop()
+            worker.join()
+            writer.close()
+            supply.stop()
+            arduino.stop()
+    if not count:
+        raise ValueError(f'No Arduino samples replayed from {path}')
+    elapsed = last - start
+    return {'replay time (s)': elapsed, 'replay arduino samples/s': count / elapsed}
+
+
+def flatten(latency, *others):
+    metrics = {}
+    for case, stats in latency.items():
+        metrics[f'{case} median (ms)'] = stats['median']
+        metrics[f'{case} p95 (ms)'] = stats['p95']
+    for other in others:
+        metrics.update(other)
+    return metrics
+
+
+def compare(metrics, baseline, tolerance):
+    # returns the metrics that got worse by more than tolerance (fraction)
+    regressions = []
+    for name, value in metrics.items():
+        if name not in baseline or not baseline[name]:
+            continue
+        change = (value - baseline[name]) / baseline[name]
+        if name.endswith('samples/s'):
+            change = -change    # higher is better
+        if change > tolerance:
+            regressions.append((name, baseline[name], value))
+    return regressions
+
+
+def print_results(results):
+    print(f"{'case':<16}{'n':>6}{'mean':>10}{'median':>10}{'p95':>10}{'max':>10}  (ms)")
+    for name, stats in results.items():
+        print(
+            f"{name:<16}{stats['n']:>6}{stats['mean']:>10.2f}{stats['median']:>10.2f}"
+            f"{stats['p95']:>10.2f}{stats['max']:>10.2f}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Mechtex RC testbench benchmarks')
+    parser.add_argument('port', nargs='?', help='serial port of the power supply')
+    parser.add_argument('--arduino', help='serial port of the Arduino (throughput and sweep)')
+    parser.add_argument('--simulate', action='store_true', help='use simulated devices')
+    parser.add_argument('--replay', help='only replay the Arduino stream of this capture')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated reply latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='simulated reply jitter (s)')
+    parser.add_argument('-n', '--count', type=int, default=100, help='commands per latency case')
+    parser.add_argument('--duration', type=float, default=5.0, help='throughput run time (s)')
+    parser.add_argument('--steps', type=int, default=10, help='steps of the sweep benchmark')
+    parser.add_argument('--json', help='write the metrics to this file')
+    parser.add_argument('--compare', help='baseline metrics file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression (fraction)')
+    args = parser.parse_args(argv)
+    if not args.simulate and not args.port and not args.replay:
+        parser.error('a supply port, --simulate or --replay is required')
+
+    if args.replay:
+        replay = run_replay_benchmark(args.replay)
+        for name, value in replay.items():
+            print(f'{name:<28}{value:>10.2f}')
+        report(replay, args)
+        return
+
+    devices = []
+    supply_port, arduino_port = args.port, args.arduino
+    if args.simulate:
+        from . import simulation
+        supply = simulation.SimulatedSupply(latency=args.latency, jitter=args.jitter, seed=1)
+        arduino = simulation.SimulatedArduino(supply=supply, latency=args.latency, seed=2)
+        devices = [supply, arduino]
+        for device in devices:
+            device.start()
+        supply_port, arduino_port = supply.port, arduino.port
+
+    try:
+        supply = m.PowerSupply(supply_port)
+        try:
+            latency = run_latency_benchmark(supply, args.count)
+        finally:
+            supply.close()
+        print_results(latency)
+        others = []
+        if arduino_port:
+            others.append(run_throughput_benchmark(supply_port, arduino_port, duration=args.duration))
+            others.append(run_sweep_benchmark(supply_port, arduino_port, steps=args.steps))
+            others.append(run_interlock_benchmark(supply_port, arduino_port))
+            for other in others:
+                for name, value in other.items():
+                    print(f'{name:<28}{value:>10.2f}')
+    finally:
+        for device in devices:
+            device.stop()
+
+    report(flatten(latency, *others), args)
+
+
+def report(metrics, args):
+    # --json and --compare
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(metrics, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(metrics, json.load(file), args.tolerance)
+        for name, before, after in regressions:
+            print(f'REGRESSION {name}: {before:.3f} -> {after:.3f}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
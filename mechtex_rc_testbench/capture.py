@@ -0,0 +1,226 @@
+import argparse
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+from . import models as m
+
+# Serial traffic capture
+#
+# Logs every byte written to and read from the supply and Arduino ports, with
+# the host time (time.perf_counter, seconds from the start of the capture).
+# Like instrumentation.py it is off by default: BufferedSerial holds
+# `recorder = None` (a class attribute) and checks it on every write / read.
+#
+#   start('field.mtxcap')
+#   ... run ...
+#   stop()
+#
+# The log is binary: MAGIC, then records of a RECORD header followed by
+# `length` bytes of data. The first record of every port is a CHANNEL record
+# whose data is '<device class>\t<port>', e.g. 'PowerSupply\tCOM11'.
+#
+# simulation.ReplayDevice plays a capture back on a pseudo terminal, so the
+# supply, the Arduino and the whole application can run against it:
+#
+#   python -m mechtex_rc_testbench.capture record field.mtxcap        # GUI
+#   python -m mechtex_rc_testbench.capture record field.mtxcap -- --config rig.json
+#   python -m mechtex_rc_testbench.capture info field.mtxcap
+#   python -m mechtex_rc_testbench.capture replay field.mtxcap -- \
+#       --config rig.json --dest-file replay/2207 --no-database
+#
+# Without arguments after '--' record / replay start the GUI, otherwise a
+# headless sweep with those cli.py options (the ports are filled in).
+#
+# A sweep waits for fresh samples after every command, so replay runs at the
+# recorded pace. The acquisition pipeline alone is replayed as fast as it can
+# take the samples by
+#
+#   python -m mechtex_rc_testbench.benchmark --replay field.mtxcap
+
+MAGIC = b'MTXCAP\x00\x01'
+# host time (s), channel index, direction, length of the data
+RECORD = struct.Struct('<dBBI')
+CHANNEL, WRITE, READ = 0, 1, 2
+
+# direction is WRITE (host -> device) or READ (device -> host)
+Record = namedtuple('Record', ['time', 'direction', 'data'])
+
+
+class Recorder:
+    # shared by all ports, records may come from the device worker, the
+    # Arduino reader and the interlock at the same time
+    WRITE = WRITE
+    READ = READ
+
+    def __init__(self, path, flush_interval=0.5):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.started = time.perf_counter()
+        self.channels = {}
+        self.records = 0
+        self._file = open(path, 'wb', buffering=1 << 16)
+        self._file.write(MAGIC)
+        self._flushed = self.started
+        self._lock = threading.Lock()
+
+    def record(self, port, direction, data):
+        now = time.perf_counter()
+        key = (type(port).__name__, port.port)
+        with self._lock:
+            if self._file is None:
+                return
+            channel = self.channels.get(key)
+            if channel is None:
+                channel = self.channels[key] = len(self.channels)
+                name = '\t'.join(str(part) for part in key).encode('utf-8')
+                self._file.write(RECORD.pack(now - self.started, channel, CHANNEL, len(name)))
+                self._file.write(name)
+            self._file.write(RECORD.pack(now - self.started, channel, direction, len(data)))
+            self._file.write(data)
+            self.records += 1
+            # a killed application loses at most flush_interval of traffic
+            if now - self._flushed > self.flush_interval:
+                self._file.flush()
+                self._flushed = now
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def start(path):
+    recorder = Recorder(path)
+    m.BufferedSerial.recorder = recorder
+    return recorder
+
+
+def stop():
+    recorder = m.BufferedSerial.recorder
+    m.BufferedSerial.recorder = None
+    if recorder is not None:
+        recorder.close()
+    return recorder
+
+
+def read_capture(path):
+    # returns {(device class, port): [Record, ...]}
+    with open(path, 'rb') as file:
+        content = file.read()
+    if not content.startswith(MAGIC):
+        raise ValueError(f'{path} is not a serial capture')
+    names = {}
+    channels = {}
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(content):
+        timestamp, channel, direction, length = RECORD.unpack_from(content, offset)
+        offset += RECORD.size
+        data = content[offset:offset + length]
+        offset += length
+        if len(data) < length:
+            # the tail of a capture that was not closed
+            break
+        if direction == CHANNEL:
+            kind, _, port = data.decode('utf-8').partition('\t')
+            names[channel] = (kind, port)
+            channels[names[channel]] = []
+        else:
+            channels[names[channel]].append(Record(timestamp, direction, data))
+    return channels
+
+
+def find_channel(channels, kind):
+    # records of the busiest port of a device class ('PowerSupply', 'Arduino')
+    candidates = [records for (name, port), records in channels.items() if name == kind]
+    if not candidates:
+        raise ValueError(f'No {kind} traffic in the capture')
+    return max(candidates, key=len)
+
+
+def summary(channels):
+    lines = []
+    for (kind, port), records in channels.items():
+        written = sum(len(record.data) for record in records if record.direction == WRITE)
+        read = sum(len(record.data) for record in records if record.direction == READ)
+        duration = records[-1].time - records[0].time if records else 0.0
+        lines.append(f'{kind} {port}: {len(records)} records, {written} bytes written, '
+                     f'{read} bytes read, {duration:.1f} s')
+    return lines
+
+
+def run_application(argv, ports=()):
+    # cli.main(argv) when there are options, otherwise the GUI with the
+    # given PortIdentity entries listed
+    if argv:
+        from . import cli
+        return cli.main(argv)
+    from .application import Application
+    app = Application(extra_ports=ports)
+    app.mainloop()
+    return 0
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    passthrough = []
+    if '--' in argv:
+        passthrough = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    parser = argparse.ArgumentParser(description='Serial traffic capture and replay')
+    commands = parser.add_subparsers(dest='command', required=True)
+    recorder = commands.add_parser('record', help='run the GUI or a headless sweep, capturing')
+    recorder.add_argument('path', help='capture file')
+    info = commands.add_parser('info', help='print what a capture holds')
+    info.add_argument('path', help='capture file')
+    replay = commands.add_parser(
+        'replay',
+        help='run the GUI or a headless sweep against a capture, at the recorded pace',
+        description='Replay runs at the recorded pace, use "python -m '
+                    'mechtex_rc_testbench.benchmark --replay" to play the samples at full speed'
+    )
+    replay.add_argument('path', help='capture file')
+    args = parser.parse_args(argv)
+
+    if args.command == 'info':
+        for line in summary(read_capture(args.path)):
+            print(line)
+        return 0
+    if args.command == 'record':
+        start(args.path)
+        try:
+            return run_application(passthrough)
+        finally:
+            print(f'{stop().records} records captured to {args.path}')
+
+    from . import discovery as d
+    from . import simulation
+    channels = read_capture(args.path)
+    # the engine's dwell runs on the host clock, a faster playback would use
+    # the samples up before it asks for them
+    clock = simulation.ReplayClock()
+    devices = {
+        'supply': simulation.ReplayDevice(find_channel(channels, 'PowerSupply'), clock, gating=False),
+        'arduino': simulation.ReplayDevice(find_channel(channels, 'Arduino'), clock),
+    }
+    for device in devices.values():
+        device.start()
+    try:
+        if passthrough:
+            passthrough += ['--supply-port', devices['supply'].port,
+                            '--arduino-port', devices['arduino'].port]
+        ports = [d.PortIdentity(device.port, kind, 'replay', args.path)
+                 for kind, device in devices.items()]
+        return run_application(passthrough, ports)
+    finally:
+        for kind, device in devices.items():
+            device.stop()
+            print(f'{kind}: {device.matched} commands matched, {device.reordered} reordered, '
+                  f'{device.repeated} repeated, {device.skipped} skipped, '
+                  f'{device.unmatched} bytes unmatched')
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+import signal
+import sqlite3
+import sys
+
+# Headless sweep runner
+#
+# Runs one automated sweep without Tk, e.g. from a scheduled task on a rig PC.
+# The options are the SetupPage.getData() fields, a JSON file with the same
+# keys (the rig definitions of orchestrator.py) can be given instead and the
+# options override it:
+#
+#   python mechtex_rc_testbench.py --supply-port COM11 --arduino-port COM12 \
+#       --num-poles 14 --num-readings 20 --max-voltage 25 --max-current 30000 \
+#       --max-thrust 3000 --max-rpm 20000 --source-file plans/2207.csv \
+#       --dest-file results/2207
+#   python mechtex_rc_testbench.py --config rig.json
+#
+# Without ports the serial ports are identified with discovery.py.
+# Only the modules a sweep needs are imported (no tkinter, no matplotlib),
+# and those only after the arguments were parsed.
+
+# (option, getData key, type, help)
+OPTIONS = (
+    ('--supply-port', 'supply_port', str, 'serial port of the power supply'),
+    ('--arduino-port', 'arduino_port', str, 'serial port of the Arduino'),
+    ('--num-poles', 'num_poles', int, 'number of motor poles'),
+    ('--num-readings', 'num_readings', int, 'readings averaged per step'),
+    ('--motor', 'motor', str, 'motor name, recorded with the run'),
+    ('--prop', 'prop', str, 'propeller name, recorded with the run'),
+    ('--max-voltage', 'max_voltage', float, 'voltage limit (V)'),
+    ('--max-current', 'max_current', float, 'current limit (mA)'),
+    ('--max-thrust', 'max_thrust', float, 'thrust limit (gf)'),
+    ('--max-rpm', 'max_rpm', float, 'RPM limit'),
+    ('--source-file', 'source_file', str, 'test plan (csv, or json for an adaptive plan)'),
+    ('--dest-file', 'dest_file', str, 'result file name, without extension'),
+)
+
+REQUIRED = ('num_poles', 'num_readings', 'max_voltage', 'max_current',
+            'max_thrust', 'max_rpm', 'source_file', 'dest_file')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run an automated sweep without the GUI')
+    parser.add_argument('--config', help='JSON file with the setup fields')
+    for option, key, kind, text in OPTIONS:
+        parser.add_argument(option, dest=key, type=kind, help=text)
+    parser.add_argument('--format', choices=('csv', 'npy'), default='csv',
+                        help='format of the raw telemetry files')
+    parser.add_argument('--settle-time', type=float, default=1.0,
+                        help='longest wait per step for the readings to settle (s)')
+    parser.add_argument('--fixed-dwell', action='store_true',
+                        help='always wait the full settle time, no settling detection')
+    parser.add_argument('--quiet', action='store_true', help='do not print every step')
+    parser.add_argument('--database', help='results database (default: ~/mechtex_results.db)')
+    parser.add_argument('--no-database', action='store_true', help='do not record the run')
+    parser.add_argument('--stats', action='store_true',
+                        help='record device I/O statistics to <dest-file>_stats.json')
+    args = parser.parse_args(argv)
+
+    data = {}
+    if args.config:
+        with open(args.config) as file:
+            data.update(json.load(file))
+    for option, key, kind, text in OPTIONS:
+        if getattr(args, key) is not None:
+            data[key] = getattr(args, key)
+    missing = [key for key in REQUIRED if data.get(key) in (None, '')]
+    if missing:
+        parser.error('missing ' + ', '.join('--' + key.replace('_', '-') for key in missing))
+    return args, data
+
+
+def find_ports(data):
+    # fills in the ports that were not given from the identified devices
+    from . import discovery as d
+    for port in d.PortDiscovery().discover():
+        key = {'supply': 'supply_port', 'arduino': 'arduino_port'}.get(port.kind)
+        if key is not None and not data.get(key):
+            data[key] = port.device
+            print(f'{port.kind}: {port.device} ({port.identity})')
+    for key in ('supply_port', 'arduino_port'):
+        if not data.get(key):
+            raise SystemExit(f'No {key.split("_")[0]} found, give --{key.replace("_", "-")}')
+
+
+def print_step(result, total):
+    print(f'step {result.step}/{total}: {result.voltage:.2f} V, {result.current:.3f} A, '
+          f'{result.thrust:.1f} gf, {result.rpm:.0f} rpm', flush=True)
+
+
+def main(argv=None):
+    args, data = parse_args(argv)
+    if not data.get('supply_port') or not data.get('arduino_port'):
+        find_ports(data)
+
+    from . import automated_script as a
+    from . import results as r
+    from . import storage as s
+    stats = None
+    if args.stats:
+        from . import instrumentation
+        stats = instrumentation.enable()
+
+    store = None
+    try:
+        plan = a.load_test_plan(data['source_file'], data)
+        if not args.no_database:
+            store = r.ResultStore(args.database or r.DEFAULT_PATH)
+        writer = s.RunWriter(
+            data['dest_file'], a.StepResult._fields, format=args.format, metadata=data, store=store
+        )
+    except (OSError, ValueError, sqlite3.Error) as error:
+        if store is not None:
+            store.close()
+        print(error, file=sys.stderr)
+        return 1
+    try:
+        return run_sweep(args, data, plan, writer, stats)
+    finally:
+        if store is not None:
+            # checkpoints the WAL into the database file
+            store.close()
+
+
+def run_sweep(args, data, plan, writer, stats):
+    from . import automated_script as a
+    finished = []
+    try:
+        engine = a.SweepEngine(
+            data,
+            plan=plan,
+            writer=writer,
+            settle_time=args.settle_time,
+            settling=not args.fixed_dwell,
+            on_step=None if args.quiet else print_step,
+            on_finish=finished.append
+        )
+    except ValueError as error:
+        writer.close()
+        print(error, file=sys.stderr)
+        return 1
+    # SIGTERM from a scheduler stops the sweep like Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: engine.abort())
+    engine.start()
+    try:
+        while engine.is_alive():
+            engine.join(0.2)
+    except KeyboardInterrupt:
+        engine.abort()
+        engine.join()
+    error = finished[0] if finished else None
+    if stats is not None:
+        stats.export(os.path.splitext(data['dest_file'])[0] + '_stats.json')
+    if error is not None:
+        print(f'Sweep failed: {error}', file=sys.stderr)
+        return 1
+    print(f'{len(engine.results)} of {len(plan)} steps written to {data["dest_file"]}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
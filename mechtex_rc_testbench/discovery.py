@@ -0,0 +1,152 @@
+import json
+import serial
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from serial.tools.list_ports import comports
+from . import models as m
+
+# Port discovery
+#
+# Lists the serial ports and identifies what is connected to each of them:
+# '*IDN?' for the power supply, the binary handshake for the Arduino. All
+# candidate ports are probed in parallel with short timeouts. Identified
+# devices are cached by USB VID/PID/serial number (device path for ports
+# without one), so a refresh only probes ports nothing was found on yet (a
+# supply that was switched off shows up once it answers). refresh=True
+# probes every port again, it is the GUI's Re-scan All button.
+#
+#   discovery = PortDiscovery(cache_file='ports.json')
+#   for port in discovery.discover():
+#       print(port.device, port.kind, port.identity)
+
+
+# kind is 'supply', 'arduino' or None when nothing answered
+PortIdentity = namedtuple('PortIdentity', ['device', 'kind', 'identity', 'description'])
+
+
+class PortDiscovery:
+
+    def __init__(self, cache_file=None, supply_timeout=0.3, arduino_timeout=2.5, max_workers=8,
+                 extra=()):
+        self.cache_file = cache_file
+        # PortIdentity entries listed as they are, without probing (e.g. the
+        # pseudo terminals of simulation.py, which comports() does not list)
+        self.extra = list(extra)
+        self.supply_timeout = supply_timeout
+        self.arduino_timeout = arduino_timeout
+        self.max_workers = max_workers
+        self.cache = {}
+        self._lock = threading.Lock()
+        if cache_file is not None:
+            self._loadCache()
+
+    def discover(self, skip=(), refresh=False):
+        # skip: devices that are in use by us and must not be opened
+        ports = [port for port in comports() if port.device not in skip]
+        unknown = [port for port in ports if refresh or self._key(port) not in self.cache]
+        if unknown:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(unknown))) as pool:
+                for port, result in zip(unknown, pool.map(self.probe, [p.device for p in unknown])):
+                    with self._lock:
+                        if result is not None and result[0] is not None:
+                            self.cache[self._key(port)] = result
+                        elif result is not None:
+                            # nothing answered (any more), probed again next time
+                            self.cache.pop(self._key(port), None)
+            if self.cache_file is not None:
+                self._saveCache()
+        identities = []
+        for port in ports:
+            kind, identity = self.cache.get(self._key(port), (None, None))
+            identities.append(PortIdentity(port.device, kind, identity, port.description))
+        return identities + [port for port in self.extra if port.device not in skip]
+
+    def probe(self, device):
+        # returns (kind, identity), (None, None) if nothing answered, or None
+        # if the port could not be opened (busy)
+        try:
+            identity = self._probeSupply(device)
+            if identity:
+                return 'supply', identity
+            identity = self._probeArduino(device)
+            if identity:
+                return 'arduino', identity
+        except (serial.SerialException, OSError):
+            return None
+        return None, None
+
+    def forget(self, device=None):
+        # drops one port (or everything) from the cache, it is probed again
+        with self._lock:
+            if device is None:
+                self.cache.clear()
+            else:
+                for port in comports():
+                    if port.device == device:
+                        self.cache.pop(self._key(port), None)
+
+    # Private methods
+    @staticmethod
+    def _key(port):
+        if port.vid is not None and port.serial_number:
+            return f'{port.vid:04X}:{port.pid:04X}:{port.serial_number}'
+        return port.device
+
+    def _probeSupply(self, device):
+        with serial.Serial(device, 9600, timeout=self.supply_timeout) as port:
+            port.reset_input_buffer()
+            port.write(b'*IDN?' + m.PowerSupply.terminator)
+            reply = port.read_until(m.PowerSupply.terminator)
+        if not reply.endswith(m.PowerSupply.terminator):
+            return None
+        try:
+            return reply.decode('ascii').strip() or None
+        except UnicodeDecodeError:
+            return None
+
+    def _probeArduino(self, device):
+        try:
+            arduino = m.Arduino(device, boot_timeout=self.arduino_timeout)
+        except serial.SerialTimeoutException:
+            return None
+        arduino.close()
+        return f'Arduino {arduino.identity:08X}'
+
+    def _loadCache(self):
+        try:
+            with open(self.cache_file) as file:
+                # files of older versions also hold ports nothing answered on
+                self.cache = {
+                    key: tuple(value) for key, value in json.load(file).items() if value[0]
+                }
+        except (OSError, ValueError):
+            self.cache = {}
+
+    def _saveCache(self):
+        with self._lock:
+            cache = dict(self.cache)
+        try:
+            with open(self.cache_file, 'w') as file:
+                json.dump(cache, file, indent=2)
+        except OSError:
+            pass
+
+
+class DiscoveryThread(threading.Thread):
+    # runs one discover() in the background, on_done(identities or error)
+    # is called from this thread
+
+    def __init__(self, discovery, on_done, skip=(), refresh=False):
+        super().__init__(name='port-discovery', daemon=True)
+        self.discovery = discovery
+        self.on_done = on_done
+        self.skip = skip
+        self.refresh = refresh
+
+    def run(self):
+        try:
+            result = self.discovery.discover(self.skip, self.refresh)
+        except Exception as error:
+            result = error
+        self.on_done(result)
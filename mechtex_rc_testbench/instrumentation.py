@@ -0,0 +1,135 @@
+import bisect
+import json
+import math
+import threading
+import time
+from . import models as m
+from . import workers as w
+
+# Device I/O instrumentation
+#
+# Off by default: the devices and the worker hold `stats = None` (a class
+# attribute) and every hook is a single `if self.stats is not None` check.
+# enable() installs one Stats object for all of them, it is picked up by
+# devices that are already open as well.
+#
+#   stats = enable()
+#   ... run ...
+#   stats.export('results/2207_stats.json')
+#   disable()
+#
+# What is recorded (times from time.perf_counter):
+#   latency   PowerSupply <query>    write to complete reply, per SCPI query
+#             <device>.<method>      execution on the device worker
+#             worker.queue_wait      submit() to the start of execution
+#             publish.<kind>         time spent in the telemetry sinks
+#   counters  <Device>.bytes_out / bytes_in, PowerSupply.timeouts,
+#             Arduino.handshake_retries, Arduino.resyncs, worker.errors
+#   gauges    worker.queue_depth, worker.setpoints_pending, Arduino.batch
+#
+# Comparing the PowerSupply query latency with <device>.<method> and the
+# queue wait tells instrument / USB time apart from time spent in our code.
+
+
+class Histogram:
+    # log spaced buckets from 1 us to 100 s, 10 per decade
+    EDGES = [10 ** (exponent / 10) for exponent in range(-60, 21)]
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.EDGES) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_right(self.EDGES, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        # upper edge of the bucket holding the fraction, clamped to min / max
+        if not self.count:
+            return math.nan
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                edge = self.EDGES[index] if index < len(self.EDGES) else self.max
+                return min(max(edge, self.min), self.max)
+        return self.max
+
+    def summary(self):
+        # milliseconds
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'mean': self.total / self.count * 1000,
+            'min': self.min * 1000,
+            'p50': self.percentile(0.5) * 1000,
+            'p95': self.percentile(0.95) * 1000,
+            'p99': self.percentile(0.99) * 1000,
+            'max': self.max * 1000,
+        }
+
+
+class Stats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.latencies = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def latency(self, key, seconds):
+        with self._lock:
+            histogram = self.latencies.get(key)
+            if histogram is None:
+                histogram = self.latencies[key] = Histogram()
+            histogram.add(seconds)
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, key, value):
+        # keeps the last and the highest value
+        with self._lock:
+            last, peak = self.gauges.get(key, (value, value))
+            self.gauges[key] = (value, max(peak, value))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'duration': time.perf_counter() - self.started,
+                'latency_ms': {key: h.summary() for key, h in sorted(self.latencies.items())},
+                'counters': dict(sorted(self.counters.items())),
+                'gauges': {key: {'last': last, 'max': peak}
+                           for key, (last, peak) in sorted(self.gauges.items())},
+            }
+
+    def export(self, path):
+        with open(path, 'w') as file:
+            json.dump(self.snapshot(), file, indent=2)
+
+
+def enable(stats=None):
+    stats = stats if stats is not None else Stats()
+    m.BufferedSerial.stats = stats
+    w.DeviceWorker.stats = stats
+    return stats
+
+
+def disable():
+    m.BufferedSerial.stats = None
+    w.DeviceWorker.stats = None
+
+
+def active():
+    # the installed Stats, None when disabled
+    return w.DeviceWorker.stats
@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+
+# Safety interlock
+#
+# The SetupPage limits (max_voltage, max_current, max_thrust, max_rpm) are
+# enforced twice:
+#   - in hardware: OVP and the current limit are programmed into the supply
+#     (Interlock.programLimits), so they hold even if the host stalls
+#   - in software: the Interlock is a telemetry sink that hands every sample
+#     to its own thread. On the first reading above a limit it calls
+#     DeviceWorker.trip(), which writes PWM 1000 and 0 V straight to the
+#     ports from this thread, ahead of anything the worker is doing or has
+#     queued, and latches the worker until the run is restarted.
+#
+#   interlock = Interlock(worker, data, on_trip=print)
+#   worker.sinks.append(interlock)
+#   interlock.start()
+#   interlock.programLimits()
+#
+# check_latency_max is the worst delay between a sample being published and
+# being checked, trip_latency the delay between the offending sample being
+# published and the cut-off commands being written (both in seconds).
+
+
+class SafetyLimitError(Exception):
+    pass
+
+
+def require_limits(data):
+    # an unset (0) limit would program 0 V OVP and trip on the first sample
+    for limit in ('max_voltage', 'max_current', 'max_thrust', 'max_rpm'):
+        if data[limit] <= 0:
+            raise ValueError(f'{limit} must be set before driving the motor')
+
+
+def check_limits(data, voltage=None, current=None, thrust=None, rpm=None):
+    # raises SafetyLimitError for the first reading above its max_* limit,
+    # current is in A while max_current is entered in mA
+    readings = [
+        ('voltage', voltage, data['max_voltage'], 'V'),
+        ('current', None if current is None else current * 1000, data['max_current'], 'mA'),
+        ('thrust', thrust, data['max_thrust'], 'gf'),
+        ('rpm', rpm, data['max_rpm'], 'rpm'),
+    ]
+    for name, value, limit, unit in readings:
+        if value is not None and value > limit:
+            raise SafetyLimitError(f'{name} {value:.4g} {unit} above limit {limit:.4g} {unit}')
+
+
+class Interlock(threading.Thread):
+
+    def __init__(self, worker, data, on_trip=None):
+        super().__init__(name='interlock', daemon=True)
+        self.worker = worker
+        self.data = data
+        self.num_poles = data['num_poles']
+        # called with the SafetyLimitError from this thread, after the cut-off
+        self.on_trip = on_trip
+        self.violation = None
+        self.checked = 0
+        self.check_latency_max = 0.0
+        self.trip_latency = None
+        self._samples = queue.SimpleQueue()
+
+    def __call__(self, kind, timestamp, payload):
+        # telemetry sink, runs on the publishing thread: hand over only
+        if self.violation is None:
+            self._samples.put((kind, timestamp, payload))
+
+    def stop(self):
+        self._samples.put(None)
+
+    def programLimits(self):
+        # hardware OVP and current limit, returns the worker futures
+        return [
+            self.worker.submit('supply', 'setOVP', self.data['max_voltage']),
+            self.worker.submit('supply', 'setCurrentLimit', self.data['max_current'] / 1000),
+        ]
+
+    def check(self, kind, payload):
+        if kind == 'supply':
+            check_limits(self.data, voltage=payload.voltage, current=payload.current)
+            return
+        # a batch of Arduino samples, the shortest pulse period is the
+        # highest RPM
+        thrust = max(sample.thrust for sample in payload)
+        period = min((sample.period for sample in payload if sample.period), default=0)
+        rpm = 120e6 / (period * self.num_poles) if period else 0.0
+        check_limits(self.data, thrust=thrust, rpm=rpm)
+
+    def trip(self, error, timestamp=None):
+        self.worker.trip(error)
+        if timestamp is not None:
+            self.trip_latency = time.monotonic() - timestamp
+        self.violation = error
+        if self.on_trip is not None:
+            self.on_trip(error)
+
+    def run(self):
+        while True:
+            item = self._samples.get()
+            if item is None:
+                return
+            kind, timestamp, payload = item
+            try:
+                self.check(kind, payload)
+            except SafetyLimitError as error:
+                self.trip(error, timestamp)
+                return
+            self.checked += 1
+            self.check_latency_max = max(self.check_latency_max, time.monotonic() - timestamp)
@@ -1,90 +1,383 @@
 import serial
+import struct
+import threading
 import time
+from collections import namedtuple
 
-class PowerSupply(serial.Serial):
-    def __init__(self, comPort):
-        super().__init__(comPort)
+
+# Result of PowerSupply.measure(), fields that were not requested stay None
+Measurement = namedtuple(
+    'Measurement',
+    ['voltage', 'current', 'power', 'output'],
+    defaults=[None, None, None, None]
+)
+
+# Sample streamed by the Arduino: device time (us), thrust (gf),
+# RPM sensor pulse period (us, 0 when stalled) and the PWM (us) it is outputting
+ArduinoSample = namedtuple('ArduinoSample', ['timestamp', 'thrust', 'period', 'pwm'])
+
+
+class BufferedSerial(serial.Serial):
+    # Serial port with a receive buffer: every read drains all bytes the driver
+    # holds in one call, partial messages stay buffered until completed
+
+    # size of the chunk drained from the driver per read call
+    read_chunk_size = 4096
+    # instrumentation.Stats while instrumentation is enabled
+    stats = None
+    # capture.Recorder while the serial traffic is captured
+    recorder = None
+
+    def __init__(self, *args, **kwargs):
+        self._rxBuffer = bytearray()
+        self._rxChunk = memoryview(bytearray(self.read_chunk_size))
+        self._writeLock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def write(self, data):
+        # the interlock writes from its own thread while the device worker
+        # may be using the port, every command goes out in one piece
+        if self.stats is not None:
+            self.stats.count(f'{type(self).__name__}.bytes_out', len(data))
+        with self._writeLock:
+            if self.recorder is not None:
+                self.recorder.record(self, self.recorder.WRITE, data)
+            return super().write(data)
+
+    def _fillBuffer(self):
+        # drains everything the driver already holds in a single call, or
+        # blocks (up to the port timeout) for the next byte if nothing is waiting
+        count = min(max(self.in_waiting, 1), len(self._rxChunk))
+        received = self.readinto(self._rxChunk[:count])
+        self._rxBuffer += self._rxChunk[:received]
+        if self.stats is not None and received:
+            self.stats.count(f'{type(self).__name__}.bytes_in', received)
+        if self.recorder is not None and received:
+            self.recorder.record(self, self.recorder.READ, self._rxChunk[:received])
+        return received
+
+    def reset_input_buffer(self):
+        super().reset_input_buffer()
+        self._rxBuffer.clear()
+
+
+class PowerSupply(BufferedSerial):
+    # SCPI messages are framed with a line terminator, so replies are read
+    # until the terminator arrives (or the timeout expires) instead of
+    # waiting a fixed delay after every command
+    terminator = b'\n'
+
+    # Shadow registers of the setpoints. Only this class changes them, so the
+    # last value written is what the supply holds: writing an unchanged value
+    # is skipped and the setpoint getters answer from the cache. Cleared by
+    # rst(), reconnect() and invalidateCache(), reloaded by resync().
+    # Measurements (MEAS:*) always go to the instrument.
+    setpoint_commands = {
+        'VOLT': ('VOLT {}', 'VOLT?'),
+        'CURR': ('CURR {}', 'CURR?'),
+        'OVP': ('SOUR:VOLT:PROT {}', 'SOUR:VOLT:PROT?'),
+    }
+
+    def __init__(self, comPort, timeout=1.0):
+        self._shadow = {}
+        super().__init__(comPort, timeout=timeout)
         self.baudrate = 9600
         self.parity = 'N'
         self.bytesize = 8
         self.stopbits = 1
-        
+
+        # whatever the supply sent before the port was opened
+        self.reset_input_buffer()
         self.rst()
-        time.sleep(0.05)
-    
+
     def rst(self):
-        self.write(b'*RST')
-        time.sleep(0.05)
+        # *OPC? blocks until the reset has completed
+        self.invalidateCache()
+        self._query('*RST;*OPC?')
+
+    # setpoint cache
+    def invalidateCache(self):
+        self._shadow.clear()
+
+    def resync(self):
+        # reads all setpoints back in one query, returns them as a dict
+        self.invalidateCache()
+        keys = list(self.setpoint_commands)
+        reply = self._query(';'.join(self.setpoint_commands[key][1] for key in keys))
+        values = reply.split(';')
+        if len(values) != len(keys):
+            raise serial.SerialException(f'Unexpected reply to resync(): {reply!r}')
+        self._shadow.update((key, self._toFloat(value)) for key, value in zip(keys, values))
+        return dict(self._shadow)
+
+    def reconnect(self):
+        # reopens the port (e.g. after a USB dropout), the supply may have
+        # been changed in between so the cache is dropped
+        self.invalidateCache()
+        self.close()
+        self.open()
+        self.reset_input_buffer()
 
     def getID(self):
-        self.write(b'*IDN?')
-        return self._getResponse()
-    
+        return self._query('*IDN?')
+
     def checkMode(self):
-        self.write(b'SYST:LOCK:OWN?')
-        return self._getResponse()
-    
+        return self._query('SYST:LOCK:OWN?')
+
     # Output control commands
     def turnOutputON(self):
-        self.write(b'OUTP ON')
-        time.sleep(0.05)
+        self._sendCommand('OUTP ON')
 
     def turnOutputOFF(self):
-        self.write(b'OUTP OFF')
-        time.sleep(0.05)
-    
+        self._sendCommand('OUTP OFF')
+
     def checkOutput(self):
-        self.write(b'OUTP?')
-        return self._getResponse()
+        return self._query('OUTP?')
 
     # Setting and getting OVP
     def setOVP(self, value):
-        setCommand = f'SOUR:VOLT:PROT {value}'
-        self.write(bytes(setCommand, encoding='ascii'))
-        time.sleep(0.05)
-    
+        self._setSetpoint('OVP', value)
+
     def getOVP(self):
-        self.write(b'SOUR:VOLT:PROT?')
-        return self._getResponse()
-    
+        return self._getSetpoint('OVP')
+
     # voltage commands
     def setVoltage(self, value):
-        setCommand = f'VOLT {value}'
-        self.write(bytes(setCommand, encoding='ASCII'))
-        time.sleep(0.05)
+        self._setSetpoint('VOLT', value)
 
     def getVoltage(self):
         # returns only the set voltage, not actual voltage
-        self.write(b'VOLT?')
-        return self._getResponse()
-    
+        return self._getSetpoint('VOLT')
+
     def getActualVoltage(self):
         # returns the actual voltage
-        self.write(b'MEAS:VOLT?')
-        return self._getResponse()
-    
+        return self._query('MEAS:VOLT?')
+
     # current commands
     def setCurrentLimit(self, value):
-        setCommand = f'CURR {value}'
-        self.write(bytes(setCommand, encoding='ASCII'))
-        time.sleep(0.05)
-    
+        self._setSetpoint('CURR', value)
+
     def getCurrentLimit(self):
-        self.write(b'CURR?')
-        return self._getResponse()
-    
+        return self._getSetpoint('CURR')
+
     def getActualCurrent(self):
-        self.write(b'MEAS:CURR?')
-        return self._getResponse()
-    
+        return self._query('MEAS:CURR?')
+
+    # batched measurements
+    # maps the short names accepted by measure() to (query, Measurement field)
+    measure_queries = {
+        'VOLT': ('MEAS:VOLT?', 'voltage'),
+        'CURR': ('MEAS:CURR?', 'current'),
+        'POW': ('MEAS:POW?', 'power'),
+        'OUTP': ('OUTP?', 'output'),
+    }
+
+    def measure(self, fields=('VOLT', 'CURR')):
+        # sends all queries as one ';' joined line and parses the single
+        # reply, e.g. measure(['VOLT', 'CURR']) -> Measurement(voltage=12.0, current=1.5)
+        return self._parseMeasurement(fields, self._query(self._measureCommand(fields)))
+
     # Private methods
+    def _sendCommand(self, command):
+        self.write(command.encode('ascii') + self.terminator)
+
+    def _query(self, command):
+        # a late reply to an earlier query must not be taken for this one
+        self.reset_input_buffer()
+        if self.stats is None:
+            self._sendCommand(command)
+            return self._getResponse()
+        start = time.perf_counter()
+        self._sendCommand(command)
+        try:
+            return self._getResponse()
+        except serial.SerialTimeoutException:
+            self.stats.count('PowerSupply.timeouts')
+            raise
+        finally:
+            self.stats.latency(f'PowerSupply {command}', time.perf_counter() - start)
+
     def _getResponse(self):
-        received_message = b''
-        time.sleep(0.05)
-        while self.inWaiting():
-            received_message += self.read()
-        return received_message.decode('ASCII')
+        # returns as soon as a complete line is in, raises if the supply
+        # did not answer within the port timeout
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            received_message = self._popLine()
+            if received_message is not None:
+                return received_message
+            if not self._fillBuffer() or (deadline is not None and time.monotonic() > deadline):
+                partial = bytes(self._rxBuffer)
+                # the rest of this reply is still on its way, none of it
+                # belongs to the next query
+                self.reset_input_buffer()
+                raise serial.SerialTimeoutException(
+                    f'Incomplete reply from power supply: {partial!r}'
+                )
+
+    def _popLine(self):
+        # next complete line from the receive buffer, None if there is none yet
+        end = self._rxBuffer.find(self.terminator)
+        if end < 0:
+            return None
+        line = self._rxBuffer[:end].decode('ascii')
+        del self._rxBuffer[:end + len(self.terminator)]
+        return line.strip()
+
+    def _setSetpoint(self, key, value):
+        if self._shadow.get(key) == float(value):
+            return
+        self._sendCommand(self.setpoint_commands[key][0].format(value))
+        self._shadow[key] = float(value)
+
+    def _getSetpoint(self, key):
+        if key not in self._shadow:
+            self._shadow[key] = self._toFloat(self._query(self.setpoint_commands[key][1]))
+        return self._shadow[key]
+
+    def _measureCommand(self, fields):
+        return ';'.join(self.measure_queries[field.upper()][0] for field in fields)
+
+    def _parseMeasurement(self, fields, reply):
+        names = [self.measure_queries[field.upper()][1] for field in fields]
+        values = reply.split(';')
+        if len(values) != len(names):
+            raise serial.SerialException(f'Unexpected reply to measure({list(fields)}): {reply!r}')
+        return Measurement(**{name: self._toFloat(value) for name, value in zip(names, values)})
+
+    @staticmethod
+    def _toFloat(value):
+        value = value.strip()
+        if value in ('ON', 'OFF'):
+            return 1.0 if value == 'ON' else 0.0
+        return float(value)
+
+
+
+
+class Arduino(BufferedSerial):
+    # Thrust / RPM acquisition board, binary framed protocol.
+    #
+    # Arduino -> PC, 17 bytes, little endian:
+    #   0xA5 | kind | timestamp u32 (us) | thrust f32 (gf) | period u32 (us) | pwm u16 (us) | checksum
+    # Sample frames have kind 'S'. The reply to a handshake has kind 'H' and
+    # carries HELLO_MAGIC in the timestamp field.
+    #
+    # PC -> Arduino, 5 bytes: 0x5A | command | value u16 | checksum
+    #   'P' set PWM (us), 'S' start streaming (samples/s), 'X' stop streaming,
+    #   'N' number of readings to average on the board, 'H' handshake
+    #
+    # The checksum is the low byte of the sum of all bytes between the sync
+    # byte and the checksum.
+    FRAME = struct.Struct('<BBIfIHB')
+    COMMAND = struct.Struct('<BBHB')
+    FRAME_SYNC = 0xA5
+    COMMAND_SYNC = 0x5A
+    SAMPLE = ord('S')
+    HELLO = ord('H')
+    HELLO_MAGIC = 0x4D545842    # 'MTXB'
+
+    def __init__(self, comPort, baudrate=1000000, timeout=0.1, boot_timeout=3.0):
+        super().__init__(comPort, baudrate=baudrate, timeout=timeout)
+        self.streaming = False
+        self.frame_errors = 0
+        self.identity = None
+        # seconds from the last handshake request to its reply
+        self.handshake_rtt = None
+        self._pendingSamples = []
+        # opening the port resets most boards, wait for the bootloader to finish
+        self.waitReady(boot_timeout)
+
+    def waitReady(self, timeout):
+        deadline = time.monotonic() + timeout
+        while not self.hello(0.1):
+            if self.stats is not None:
+                self.stats.count('Arduino.handshake_retries')
+            if time.monotonic() > deadline:
+                raise serial.SerialTimeoutException(f'No handshake from Arduino on {self.port}')
+
+    def hello(self, timeout=0.5):
+        # handshake, returns True if the board answered with HELLO_MAGIC
+        self.identity = None
+        sent = time.monotonic()
+        self._sendCommand(self.HELLO)
+        deadline = sent + timeout
+        while self.identity is None and time.monotonic() < deadline:
+            self._fillBuffer()
+            self._pendingSamples += self._parseFrames()
+        if self.identity == self.HELLO_MAGIC:
+            self.handshake_rtt = time.monotonic() - sent
+            return True
+        return False
+
+    # PWM output, does not wait for any reply: the value actually applied is
+    # echoed back in every sample
+    def setPWM(self, value):
+        self._sendCommand(ord('P'), int(value))
+
+    def setAveraging(self, value):
+        self._sendCommand(ord('N'), int(value))
+
+    # streaming mode
+    def startStream(self, rate=1000):
+        self._sendCommand(ord('S'), int(rate))
+        self.streaming = True
+
+    def stopStream(self):
+        self._sendCommand(ord('X'))
+        self.streaming = False
+
+    def readSamples(self):
+        # returns all complete samples received so far, waits at most the
+        # port timeout for the first byte if nothing is buffered
+        samples = self._pendingSamples
+        self._pendingSamples = []
+        if not samples or self.in_waiting:
+            self._fillBuffer()
+        samples += self._parseFrames()
+        if self.stats is not None:
+            self.stats.gauge('Arduino.batch', len(samples))
+        return samples
+
+    @classmethod
+    def packFrame(cls, kind, timestamp, thrust, period, pwm):
+        # builds a device -> PC frame, used by the simulated board
+        frame = bytearray(cls.FRAME.pack(cls.FRAME_SYNC, kind, timestamp, thrust, period, pwm, 0))
+        frame[-1] = sum(frame[1:-1]) & 0xFF
+        return bytes(frame)
+
+    # Private methods
+    def _sendCommand(self, command, value=0):
+        checksum = (command + (value & 0xFF) + (value >> 8)) & 0xFF
+        self.write(self.COMMAND.pack(self.COMMAND_SYNC, command, value, checksum))
 
+    def _parseFrames(self):
+        samples = []
+        buffer = self._rxBuffer
+        size = self.FRAME.size
+        start = 0
+        while True:
+            start = buffer.find(self.FRAME_SYNC, start)
+            if start < 0:
+                start = len(buffer)
+                break
+            if len(buffer) - start < size:
+                break
+            sync, kind, timestamp, thrust, period, pwm, checksum = self.FRAME.unpack_from(buffer, start)
+            if sum(buffer[start + 1:start + size - 1]) & 0xFF != checksum \
+                    or kind not in (self.SAMPLE, self.HELLO):
+                # not a frame boundary (or a corrupted frame), resync on the next sync byte
+                self.frame_errors += 1
+                if self.stats is not None:
+                    self.stats.count('Arduino.resyncs')
+                start += 1
+                continue
+            if kind == self.SAMPLE:
+                samples.append(ArduinoSample(timestamp, thrust, period, pwm))
+            else:
+                self.identity = timestamp
+            start += size
+        del buffer[:start]
+        return samples
 
 
 # supply = PowerSupply('COM11')
@@ -92,4 +385,4 @@ class PowerSupply(serial.Serial):
 # supply.setCurrentLimit(5.00)
 # time.sleep(3)
 # print(supply.getCurrentLimit())
-# print(supply.getActualCurrent())
\ No newline at end of file
+# print(supply.getActualCurrent())
@@ -0,0 +1,167 @@
+import argparse
+import json
+import multiprocessing
+import queue
+import signal
+from . import automated_script as a
+from . import storage as s
+
+# Headless multi-rig runner
+#
+# Every rig runs its sweep in its own process (device worker, Arduino reader
+# and sweep engine threads included), so rigs never share a GIL and a hung or
+# crashed rig cannot hold up the others. Progress and results come back to
+# this process through one event queue.
+#
+# A rig definition has the keys of SetupPage.getData() plus a 'name':
+#
+#   [{"name": "stand-1", "supply_port": "/dev/ttyUSB0", "arduino_port": "/dev/ttyACM0",
+#     "num_poles": 14, "num_readings": 20, "max_voltage": 25, "max_current": 30000,
+#     "max_thrust": 3000, "max_rpm": 20000,
+#     "source_file": "plans/2207.csv", "dest_file": "results/stand-1"}, ...]
+#
+#   python -m mechtex_rc_testbench.orchestrator rigs.json
+
+
+def run_rig(rig, events, abort):
+    # entry point of a rig process. Ctrl+C reaches the whole process group,
+    # the rigs ignore it and stop through the shared abort event, so every
+    # engine still shuts its devices down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    name = rig['name']
+    finished = []
+
+    def on_step(result, total):
+        events.put(('step', name, result._asdict(), total))
+
+    error = None
+    writer = None
+    try:
+        if rig.get('dest_file'):
+            writer = s.RunWriter(rig['dest_file'], a.StepResult._fields, metadata=rig)
+        engine = a.SweepEngine(rig, writer=writer, on_step=on_step, on_finish=finished.append)
+        engine.start()
+        while engine.is_alive():
+            if abort.wait(0.2):
+                engine.abort()
+            engine.join(0.2)
+        error = finished[0] if finished else None
+    except Exception as exc:
+        error = exc
+    finally:
+        # the engine closes the writer when it shuts down, this covers an
+        # engine that failed before (or while) getting there
+        if writer is not None:
+            try:
+                writer.close(error)
+            except Exception as exc:
+                error = exc if error is None else error
+        events.put(('finished', name, None if error is None else f'{type(error).__name__}: {error}'))
+
+
+class Orchestrator:
+    # on_event(kind, rig name, *details) is called in this process for every
+    # 'step' and 'finished' event
+
+    def __init__(self, rigs, on_event=None, start_method='spawn'):
+        names = [rig['name'] for rig in rigs]
+        if len(set(names)) != len(names):
+            raise ValueError('Rig names must be unique')
+        self.rigs = rigs
+        self.on_event = on_event
+        self.context = multiprocessing.get_context(start_method)
+        self.events = self.context.Queue()
+        self.abort_event = self.context.Event()
+        self.processes = {}
+        self.status = {
+            rig['name']: {'state': 'pending', 'steps': 0, 'total': None, 'error': None, 'results': []}
+            for rig in rigs
+        }
+
+    def abort(self):
+        self.abort_event.set()
+
+    def run(self):
+        for rig in self.rigs:
+            process = self.context.Process(
+                target=run_rig,
+                args=(rig, self.events, self.abort_event),
+                name=f"rig-{rig['name']}",
+                daemon=True
+            )
+            process.start()
+            self.processes[rig['name']] = process
+            self.status[rig['name']]['state'] = 'running'
+        try:
+            while self._running():
+                try:
+                    event = self.events.get(timeout=0.5)
+                except queue.Empty:
+                    self._checkProcesses()
+                    continue
+                self._handle(event)
+        except KeyboardInterrupt:
+            self.abort()
+            self._drain()
+        for process in self.processes.values():
+            process.join()
+        return self.status
+
+    # Private methods
+    def _running(self):
+        return any(status['state'] == 'running' for status in self.status.values())
+
+    def _handle(self, event):
+        kind, name, *details = event
+        status = self.status[name]
+        if kind == 'step':
+            result, total = details
+            status['steps'] += 1
+            status['total'] = total
+            status['results'].append(result)
+        elif kind == 'finished':
+            error, = details
+            status['state'] = 'done' if error is None else 'failed'
+            status['error'] = error
+        if self.on_event is not None:
+            self.on_event(kind, name, *details)
+
+    def _checkProcesses(self):
+        # a process that died without reporting (segfault, killed, ...)
+        for name, process in self.processes.items():
+            status = self.status[name]
+            if status['state'] == 'running' and not process.is_alive():
+                self._handle(('finished', name, f'rig process exited with code {process.exitcode}'))
+
+    def _drain(self):
+        # waits for every rig to finish its shutdown (or die)
+        while self._running():
+            try:
+                self._handle(self.events.get(timeout=0.5))
+            except queue.Empty:
+                self._checkProcesses()
+
+
+def print_event(kind, name, *details):
+    if kind == 'step':
+        result, total = details
+        print(f"[{name}] step {result['step']}/{total}: "
+              f"{result['thrust']:.1f} gf, {result['rpm']:.0f} rpm, {result['current']:.3f} A")
+    else:
+        error, = details
+        print(f'[{name}] finished' if error is None else f'[{name}] FAILED: {error}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run automated sweeps on several rigs at once')
+    parser.add_argument('rigs', help='JSON file with a list of rig definitions')
+    args = parser.parse_args(argv)
+    with open(args.rigs) as file:
+        rigs = json.load(file)
+    status = Orchestrator(rigs, on_event=print_event).run()
+    failed = [name for name, rig in status.items() if rig['state'] != 'done']
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,155 @@
+import json
+from . import automated_script as a
+
+# Adaptive test plan
+#
+# Sweeps one axis ('pwm' or 'voltage') at each of the `fixed` values of the
+# other one. A coarse grid is measured first, then points are inserted
+# halfway between neighbours whose thrust, current or RPM differ by more than
+# the tolerance, until no interval qualifies or it is min_step wide. Flat
+# parts of the curve keep the coarse spacing, the knee gets the resolution.
+#
+# The tolerance is a fraction of the max_* limits of the setup data, or a
+# dict of absolute differences per channel ({'thrust': 20, 'current': 0.5,
+# 'rpm': 500}). The coarse pass stops before a point whose linear
+# extrapolation from the last two results would exceed a limit; refinement
+# only lands between measured points, and the interlock still guards
+# every sample. Set voltages above max_voltage (fixed values, or the stop of
+# a voltage sweep) are rejected when the plan is created.
+#
+# The plan is iterated by SweepEngine, which reports every result back
+# through addResult(), so the next points depend on the measurements:
+#
+#   plan = AdaptivePlan(data, axis='pwm', start=1000, stop=2000, coarse=100, fixed=[12.0, 16.0])
+#   engine = SweepEngine(data, plan=plan)
+#
+# A source file ending in .json holds the keyword arguments of AdaptivePlan,
+# see automated_script.load_test_plan.
+
+CHANNELS = ('thrust', 'current', 'rpm')
+
+
+class AdaptivePlan:
+
+    def __init__(self, data, axis='pwm', start=1000.0, stop=2000.0, coarse=100.0,
+                 min_step=None, fixed=(12.0,), tolerance=0.05, dwell=None):
+        if axis not in ('pwm', 'voltage'):
+            raise ValueError(f'Adaptive plan axis must be pwm or voltage, not {axis!r}')
+        if coarse <= 0 or stop <= start:
+            raise ValueError('Adaptive plan needs start < stop and a positive coarse step')
+        self.data = data
+        self.axis = axis
+        self.start = float(start)
+        self.stop = float(stop)
+        self.coarse = float(coarse)
+        self.min_step = float(min_step) if min_step else self.coarse / 8
+        self.fixed = [float(value) for value in fixed]
+        self.dwell = dwell
+        # the engine refuses a set point above max_voltage and stops the run
+        # there, so such a plan is rejected before anything is driven
+        voltages = self.fixed if axis == 'pwm' else [self.start, self.stop]
+        for voltage in voltages:
+            if voltage > data['max_voltage']:
+                raise ValueError(
+                    f'Adaptive plan voltage {voltage:g} V is above max_voltage {data["max_voltage"]:g} V'
+                )
+        if isinstance(tolerance, dict):
+            self.tolerance = {
+                channel: float(tolerance[channel]) for channel in CHANNELS if channel in tolerance
+            }
+        else:
+            # max_current is in mA, the results in A
+            self.tolerance = {
+                'thrust': tolerance * data['max_thrust'],
+                'current': tolerance * data['max_current'] / 1000,
+                'rpm': tolerance * data['max_rpm'],
+            }
+        # measured points of the current fixed value: axis value -> StepResult
+        self.measured = {}
+        self.planned = len(self.fixed) * (int(round((self.stop - self.start) / self.coarse)) + 1)
+        self._last = None
+
+    @classmethod
+    def fromFile(cls, path, data):
+        with open(path) as file:
+            spec = json.load(file)
+        try:
+            return cls(data, **spec)
+        except TypeError as error:
+            raise ValueError(f'Adaptive plan {path}: {error}') from None
+
+    def __len__(self):
+        # estimate, grows as points are inserted
+        return self.planned
+
+    def __iter__(self):
+        for value in self.fixed:
+            self.measured = {}
+            yield from self._coarsePass(value)
+            yield from self._refine(value)
+
+    def addResult(self, step, result):
+        self._last = result
+        self.measured[getattr(step, self.axis)] = result
+
+    # Private methods
+    def _step(self, position, value):
+        self._last = None
+        if self.axis == 'pwm':
+            return a.PlanStep(voltage=value, pwm=position, dwell=self.dwell)
+        return a.PlanStep(voltage=position, pwm=value, dwell=self.dwell)
+
+    def _coarsePass(self, value):
+        count = int(round((self.stop - self.start) / self.coarse)) + 1
+        positions = [min(self.start + i * self.coarse, self.stop) for i in range(count)]
+        for position in positions:
+            if self._limitAhead(position):
+                self.planned -= len(positions) - len(self.measured)
+                return
+            step = self._step(position, value)
+            yield step
+            if self._last is None:
+                # the engine stopped without a result
+                return
+
+    def _refine(self, value):
+        while True:
+            points = sorted(self.measured)
+            inserts = [
+                (low + high) / 2
+                for low, high in zip(points, points[1:])
+                if high - low > self.min_step and self._differs(self.measured[low], self.measured[high])
+            ]
+            if not inserts:
+                return
+            self.planned += len(inserts)
+            for position in inserts:
+                yield self._step(position, value)
+                if self._last is None:
+                    return
+
+    def _differs(self, low, high):
+        return any(
+            abs(getattr(high, channel) - getattr(low, channel)) > tolerance
+            for channel, tolerance in self.tolerance.items()
+        )
+
+    def _limitAhead(self, position):
+        # linear extrapolation of every channel from the last two points
+        if self.axis == 'voltage' and position > self.data['max_voltage']:
+            return True
+        points = sorted(self.measured)[-2:]
+        if len(points) < 2:
+            return False
+        (x0, r0), (x1, r1) = [(x, self.measured[x]) for x in points]
+        limits = {
+            'thrust': self.data['max_thrust'],
+            'current': self.data['max_current'] / 1000,
+            'rpm': self.data['max_rpm'],
+        }
+        for channel, limit in limits.items():
+            y0, y1 = getattr(r0, channel), getattr(r1, channel)
+            predicted = y1 + (y1 - y0) * (position - x1) / (x1 - x0)
+            if predicted > limit:
+                return True
+        return False
@@ -0,0 +1,129 @@
+import time
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+# Live telemetry plot for the manual page
+#
+# The plot is redrawn on its own after() timer (max_fps), not per sample.
+# Each redraw takes the last `span` seconds out of the telemetry ring buffers,
+# min/max decimates them to about one point per pixel and blits only the
+# lines onto a cached background. The full figure is redrawn only when an
+# axis has to be rescaled or the widget was resized.
+
+
+def minmax_decimate(x, y, bins):
+    # keeps the min and the max of each of `bins` equal slices (in time order),
+    # so spikes stay visible, returns at most 2 * bins points
+    n = len(y)
+    if n <= 2 * bins:
+        return x, y
+    per_bin = n // bins
+    start = n - per_bin * bins    # drop the oldest remainder
+    xb = x[start:].reshape(bins, per_bin)
+    yb = y[start:].reshape(bins, per_bin)
+    low = yb.argmin(axis=1)
+    high = yb.argmax(axis=1)
+    first = np.minimum(low, high)
+    second = np.maximum(low, high)
+    rows = np.arange(bins)
+    xs = np.empty(2 * bins)
+    ys = np.empty(2 * bins)
+    xs[0::2] = xb[rows, first]
+    xs[1::2] = xb[rows, second]
+    ys[0::2] = yb[rows, first]
+    ys[1::2] = yb[rows, second]
+    return xs, ys
+
+
+class LivePlot:
+    # (channel, axis label, source) of every subplot, top to bottom
+    CHANNELS = (
+        ('thrust', 'Thrust (gf)', 'arduino'),
+        ('rpm', 'RPM', 'arduino'),
+        ('current', 'Current (A)', 'supply'),
+        ('voltage', 'Voltage (V)', 'supply'),
+    )
+
+    def __init__(self, master, span=30.0, max_fps=20):
+        self.span = span
+        self.interval_ms = int(1000 / max_fps)
+        self.telemetry = None
+
+        self.figure = Figure(figsize=(5, 5), dpi=100)
+        self.axes = self.figure.subplots(len(self.CHANNELS), 1, sharex=True)
+        self.lines = []
+        for axis, (channel, label, source) in zip(self.axes, self.CHANNELS):
+            line, = axis.plot([], [], linewidth=1, animated=True)
+            axis.set_ylabel(label, fontsize=8)
+            axis.tick_params(labelsize=7)
+            axis.set_xlim(-span, 0)
+            self.lines.append(line)
+        self.axes[-1].set_xlabel('Time (s)', fontsize=8)
+        self.figure.tight_layout()
+
+        self.canvas = FigureCanvasTkAgg(self.figure, master=master)
+        self.widget = self.canvas.get_tk_widget()
+        self.canvas.mpl_connect('draw_event', self._onDraw)
+        self._background = None
+        self._job = None
+
+    def start(self, telemetry):
+        self.stop()
+        self.telemetry = telemetry
+        self._tick()
+
+    def stop(self):
+        if self._job is not None:
+            self.widget.after_cancel(self._job)
+            self._job = None
+
+    def redraw(self):
+        if self.telemetry is None:
+            return
+        now = time.monotonic()
+        bins = max(self.widget.winfo_width() // 2, 50)
+        rescale = self._background is None
+        for axis, line, (channel, label, source) in zip(self.axes, self.lines, self.CHANNELS):
+            times = self.telemetry.times[source]
+            values = self.telemetry[channel]
+            count = min(len(times), len(values))
+            t = times.window(count)
+            start = np.searchsorted(t, now - self.span)
+            x, y = minmax_decimate(t[start:] - now, values.window(count)[start:], bins)
+            line.set_data(x, y)
+            if len(y):
+                low, high = axis.get_ylim()
+                if y.min() < low or y.max() > high:
+                    self._setLimits(axis, y.min(), y.max())
+                    rescale = True
+        if rescale:
+            # _onDraw refreshes the background and draws the lines
+            self.canvas.draw()
+        else:
+            self._blit()
+
+    # Private methods
+    def _tick(self):
+        self._job = self.widget.after(self.interval_ms, self._tick)
+        self.redraw()
+
+    def _setLimits(self, axis, low, high):
+        # 20% headroom so slowly growing values do not force a full redraw
+        # every frame
+        margin = max(high - low, abs(high), 1e-3) * 0.2
+        axis.set_ylim(low - margin, high + margin)
+
+    def _onDraw(self, event):
+        # runs inside every full draw, the canvas shows the result afterwards
+        self._background = self.canvas.copy_from_bbox(self.figure.bbox)
+        for axis, line in zip(self.axes, self.lines):
+            axis.draw_artist(line)
+
+    def _blit(self):
+        if self._background is None:
+            return
+        self.canvas.restore_region(self._background)
+        for axis, line in zip(self.axes, self.lines):
+            axis.draw_artist(line)
+        self.canvas.blit(self.figure.bbox)
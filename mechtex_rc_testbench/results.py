@@ -0,0 +1,244 @@
+import argparse
+import datetime
+import os
+import sqlite3
+import threading
+from . import analysis as an
+
+# Results database
+#
+# Every run is recorded in one SQLite file (WAL mode, so queries never wait
+# for a sweep that is writing) next to the loose result files: the setup
+# metadata in `runs`, the averaged result of every step in `steps`. Raw
+# samples stay in the files, runs.dest_file points to them.
+#
+#   store = ResultStore()
+#   run_id = store.startRun(data)
+#   store.addSteps(run_id, results)
+#   store.finishRun(run_id)
+#
+#   store.steps(prop='1045', voltage=12.0)          # every step of a prop at 12 V
+#   store.aggregate(('motor', 'pwm_set'), prop='1045', voltage=12.0)
+#
+#   python -m mechtex_rc_testbench.results import results/
+#   python -m mechtex_rc_testbench.results query --prop 1045 --voltage 12
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), 'mechtex_results.db')
+
+# runs columns filled from the setup data (SetupPage.getData() keys)
+RUN_FIELDS = (
+    'motor', 'prop', 'num_poles', 'num_readings',
+    'max_voltage', 'max_current', 'max_thrust', 'max_rpm',
+    'supply_port', 'arduino_port', 'source_file', 'dest_file',
+)
+STEP_FIELDS = (
+    'step', 'voltage_set', 'pwm_set', 'voltage', 'current', 'thrust', 'rpm', 'pwm', 'start', 'end',
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started TEXT NOT NULL,
+    finished TEXT,
+    status TEXT NOT NULL DEFAULT 'running',
+    error TEXT,
+    motor TEXT, prop TEXT, num_poles INTEGER, num_readings INTEGER,
+    max_voltage REAL, max_current REAL, max_thrust REAL, max_rpm REAL,
+    supply_port TEXT, arduino_port TEXT, source_file TEXT, dest_file TEXT
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    step INTEGER NOT NULL,
+    voltage_set REAL, pwm_set REAL,
+    voltage REAL, current REAL, thrust REAL, rpm REAL, pwm REAL,
+    start REAL, "end" REAL,
+    PRIMARY KEY (run_id, step)
+);
+CREATE INDEX IF NOT EXISTS runs_motor_prop ON runs (motor, prop);
+CREATE INDEX IF NOT EXISTS runs_prop ON runs (prop);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE INDEX IF NOT EXISTS steps_step ON steps (step);
+CREATE INDEX IF NOT EXISTS steps_setpoint ON steps (voltage_set, pwm_set);
+"""
+
+
+def now():
+    return datetime.datetime.now().isoformat(' ', 'seconds')
+
+
+class ResultStore:
+    # One connection shared by the GUI and the sweep thread, serialized by
+    # a lock
+
+    # aggregate() group_by names and their columns
+    GROUP_COLUMNS = {'motor': 'runs.motor', 'prop': 'runs.prop',
+                     'voltage_set': 'steps.voltage_set', 'pwm_set': 'steps.pwm_set',
+                     'step': 'steps.step', 'run_id': 'runs.id'}
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self._lock, self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('PRAGMA foreign_keys=ON')
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+    # Recording
+    def startRun(self, data, started=None):
+        values = [started or now()] + [data.get(field) for field in RUN_FIELDS]
+        with self._lock, self.connection:
+            cursor = self.connection.execute(
+                f"INSERT INTO runs (started, {', '.join(RUN_FIELDS)}) "
+                f"VALUES ({', '.join('?' * len(values))})",
+                values
+            )
+        return cursor.lastrowid
+
+    def addSteps(self, run_id, steps):
+        # steps: StepResult tuples or dicts, one executemany for all of them
+        rows = []
+        for step in steps:
+            if not isinstance(step, dict):
+                step = step._asdict()
+            rows.append([run_id] + [step.get(field) for field in STEP_FIELDS])
+        columns = ', '.join(f'"{field}"' for field in STEP_FIELDS)
+        with self._lock, self.connection:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO steps (run_id, {columns}) "
+                f"VALUES ({', '.join('?' * (len(STEP_FIELDS) + 1))})",
+                rows
+            )
+
+    def finishRun(self, run_id, error=None):
+        with self._lock, self.connection:
+            self.connection.execute(
+                'UPDATE runs SET finished = ?, status = ?, error = ? WHERE id = ?',
+                (now(), 'complete' if error is None else 'failed',
+                 None if error is None else str(error), run_id)
+            )
+
+    def importRun(self, dest_file, data=None):
+        # records a run from its result files, returns the run id
+        run = an.load_run(dest_file)
+        data = dict(run['metadata'], **(data or {}))
+        data.setdefault('dest_file', os.path.splitext(dest_file)[0])
+        started = datetime.datetime.fromtimestamp(
+            os.path.getmtime(os.path.splitext(dest_file)[0] + '.csv')
+        ).isoformat(' ', 'seconds')
+        run_id = self.startRun(data, started=started)
+        names = run['steps'].dtype.names
+        self.addSteps(run_id, [
+            {name: (row[name].item() if name in names else None) for name in STEP_FIELDS}
+            for row in run['steps']
+        ])
+        self.finishRun(run_id)
+        return run_id
+
+    # Queries
+    def runs(self, **filters):
+        where, values = self._where(filters)
+        return self._fetch(f'SELECT * FROM runs WHERE {where} ORDER BY started', values)
+
+    def steps(self, **filters):
+        where, values = self._where(filters)
+        return self._fetch(
+            'SELECT runs.id AS run_id, runs.started, runs.motor, runs.prop, steps.* '
+            f'FROM steps JOIN runs ON runs.id = steps.run_id WHERE {where} '
+            'ORDER BY runs.started, steps.step',
+            values
+        )
+
+    def aggregate(self, group_by=('motor', 'prop', 'voltage_set', 'pwm_set'), **filters):
+        # count, mean / max of the step results per group, efficiency in gf/W
+        unknown = [name for name in group_by if name not in self.GROUP_COLUMNS]
+        if unknown:
+            raise ValueError(f'Unknown group columns: {", ".join(unknown)} '
+                             f'(valid: {", ".join(self.GROUP_COLUMNS)})')
+        keys = ', '.join(self.GROUP_COLUMNS[name] for name in group_by)
+        where, values = self._where(filters)
+        return self._fetch(
+            f'SELECT {keys}, COUNT(*) AS count, COUNT(DISTINCT runs.id) AS runs, '
+            'AVG(steps.thrust) AS thrust, MAX(steps.thrust) AS max_thrust, '
+            'AVG(steps.current) AS current, AVG(steps.rpm) AS rpm, '
+            'AVG(steps.thrust / NULLIF(steps.voltage * steps.current, 0)) AS efficiency '
+            f'FROM steps JOIN runs ON runs.id = steps.run_id WHERE {where} '
+            f'GROUP BY {keys} ORDER BY {keys}',
+            values
+        )
+
+    # Private methods
+    @staticmethod
+    def _where(filters):
+        # motor, prop, status: exact match; since / until: started date range;
+        # voltage / pwm: set point within tolerance (default 0.05)
+        tolerance = filters.pop('tolerance', 0.05)
+        clauses, values = ['1'], []
+        for name in ('motor', 'prop', 'status'):
+            if filters.get(name) is not None:
+                clauses.append(f'runs.{name} = ?')
+                values.append(filters.pop(name))
+        if filters.get('since') is not None:
+            clauses.append('runs.started >= ?')
+            values.append(str(filters.pop('since')))
+        if filters.get('until') is not None:
+            clauses.append('runs.started < ?')
+            values.append(str(filters.pop('until')))
+        for name, column in (('voltage', 'steps.voltage_set'), ('pwm', 'steps.pwm_set')):
+            if filters.get(name) is not None:
+                value = float(filters.pop(name))
+                clauses.append(f'{column} BETWEEN ? AND ?')
+                values += [value - tolerance, value + tolerance]
+        unknown = [name for name, value in filters.items() if value is not None]
+        if unknown:
+            raise ValueError(f'Unknown filters: {", ".join(unknown)}')
+        return ' AND '.join(clauses), values
+
+    def _fetch(self, query, values):
+        with self._lock:
+            return [dict(row) for row in self.connection.execute(query, values)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Results database')
+    parser.add_argument('--database', default=DEFAULT_PATH, help='SQLite file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    importer = commands.add_parser('import', help='record runs from their result files')
+    importer.add_argument('path', help='run (dest_file) or directory of runs')
+    importer.add_argument('--motor')
+    importer.add_argument('--prop')
+    query = commands.add_parser('query', help='print matching steps, or aggregates with --group')
+    for name in ('motor', 'prop', 'since', 'until'):
+        query.add_argument('--' + name)
+    query.add_argument('--voltage', type=float)
+    query.add_argument('--pwm', type=float)
+    query.add_argument('--group', nargs='+', choices=ResultStore.GROUP_COLUMNS,
+                       help='aggregate by these columns')
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.database)
+    if args.command == 'import':
+        extra = {key: value for key, value in (('motor', args.motor), ('prop', args.prop)) if value}
+        runs = an.find_runs(args.path) if os.path.isdir(args.path) else [args.path]
+        for dest_file in runs:
+            print(f'{dest_file}: run {store.importRun(dest_file, extra)}')
+    else:
+        filters = {name: getattr(args, name)
+                   for name in ('motor', 'prop', 'since', 'until', 'voltage', 'pwm')}
+        rows = store.aggregate(args.group, **filters) if args.group else store.steps(**filters)
+        if rows:
+            print(','.join(rows[0]))
+        for row in rows:
+            print(','.join('' if value is None else str(value) for value in row.values()))
+    store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,127 @@
+import math
+import threading
+from collections import deque
+
+# Settling detection
+#
+# Watches the streaming thrust, RPM and current samples of a sweep step and
+# tells when all of them are steady: over the last `window` seconds the least
+# squares slope and the standard deviation of every channel are below their
+# thresholds. Both are kept as running sums, adding a sample (and dropping
+# the ones that fell out of the window) is O(1).
+#
+# Thresholds are (absolute, relative) pairs, the effective threshold is
+# max(absolute, relative * |mean|); slopes are per second.
+#
+#   detector = SettlingDetector(data['num_poles'])
+#   worker.sinks.append(detector)
+#   detector.reset()            # after changing the set points
+#   ... detector.settled() ...
+#
+# Arduino samples are placed on the board's own clock (timestamp, us), the
+# samples of one serial read all arrive with the same host time.
+
+
+class ChannelWindow:
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.t0 = None
+        self.n = 0
+        self.st = self.sx = self.stt = self.sxx = self.stx = 0.0
+
+    def add(self, t, x):
+        # times are taken relative to the first sample to keep the sums small
+        if self.t0 is None:
+            self.t0 = t
+        t -= self.t0
+        self.samples.append((t, x))
+        self.n += 1
+        self.st += t
+        self.sx += x
+        self.stt += t * t
+        self.sxx += x * x
+        self.stx += t * x
+        while self.samples[0][0] < t - self.window:
+            old_t, old_x = self.samples.popleft()
+            self.n -= 1
+            self.st -= old_t
+            self.sx -= old_x
+            self.stt -= old_t * old_t
+            self.sxx -= old_x * old_x
+            self.stx -= old_t * old_x
+
+    def span(self):
+        return self.samples[-1][0] - self.samples[0][0] if self.samples else 0.0
+
+    def stats(self):
+        # mean, slope (per second) and standard deviation of the window
+        n = self.n
+        mean = self.sx / n
+        mean_t = self.st / n
+        var_t = self.stt / n - mean_t * mean_t
+        slope = (self.stx / n - mean_t * mean) / var_t if var_t > 1e-12 else 0.0
+        variance = max(self.sxx / n - mean * mean, 0.0) * n / max(n - 1, 1)
+        return mean, slope, math.sqrt(variance)
+
+
+class SettlingDetector:
+    # channel: (absolute, relative) thresholds
+    SLOPE = {'thrust': (5.0, 0.02), 'rpm': (100.0, 0.02), 'current': (0.05, 0.02)}
+    STD = {'thrust': (2.0, 0.02), 'rpm': (100.0, 0.02), 'current': (0.05, 0.02)}
+
+    def __init__(self, num_poles, window=0.3, min_samples=5, slope=None, std=None):
+        self.num_poles = num_poles
+        self.window = window
+        self.min_samples = min_samples
+        self.slope = dict(self.SLOPE, **(slope or {}))
+        self.std = dict(self.STD, **(std or {}))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.channels = {channel: ChannelWindow(self.window) for channel in self.slope}
+
+    def __call__(self, kind, timestamp, payload):
+        # telemetry sink
+        with self._lock:
+            if kind == 'supply':
+                if payload.current is not None:
+                    self.channels['current'].add(timestamp, payload.current)
+                return
+            thrust = self.channels['thrust']
+            rpm = self.channels['rpm']
+            for sample in payload:
+                t = self._boardTime(sample.timestamp)
+                thrust.add(t, sample.thrust)
+                rpm.add(t, 120e6 / (sample.period * self.num_poles) if sample.period else 0.0)
+
+    def settled(self):
+        with self._lock:
+            return all(self._steady(channel, window) for channel, window in self.channels.items())
+
+    def status(self):
+        # channel -> (mean, slope, std) for display / logging
+        with self._lock:
+            return {channel: window.stats() for channel, window in self.channels.items() if window.n}
+
+    # Private methods
+    def _steady(self, channel, window):
+        if window.n < self.min_samples or window.span() < 0.8 * self.window:
+            return False
+        mean, slope, std = window.stats()
+        slope_abs, slope_rel = self.slope[channel]
+        std_abs, std_rel = self.std[channel]
+        return abs(slope) <= max(slope_abs, slope_rel * abs(mean)) \
+            and std <= max(std_abs, std_rel * abs(mean))
+
+    def _boardTime(self, timestamp):
+        # seconds on the board clock, unwrapping the 32 bit microsecond counter
+        window = self.channels['thrust']
+        if window.samples:
+            last = window.samples[-1][0] + window.t0
+            elapsed = (timestamp - int(round(last * 1e6))) & 0xFFFFFFFF
+            return last + elapsed / 1e6
+        return timestamp / 1e6
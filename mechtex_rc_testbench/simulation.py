@@ -0,0 +1,489 @@
+import bisect
+import math
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+from collections import deque
+from . import models as m
+from .capture import READ, WRITE
+
+# Simulated bench hardware (Linux / macOS)
+#
+# Each device answers on the master side of a pseudo terminal, the slave side
+# (self.port, e.g. /dev/pts/5) is opened by PowerSupply / Arduino like any
+# serial port, so the whole application runs without hardware:
+#
+#   supply = SimulatedSupply(latency=0.005, jitter=0.002)
+#   arduino = SimulatedArduino(supply=supply)
+#   supply.start(); arduino.start()
+#   data['supply_port'], data['arduino_port'] = supply.port, arduino.port
+#
+# Every reply is delayed by latency plus a uniform random jitter (seconds).
+#
+# ReplayDevice answers with the traffic of a capture.py log instead.
+
+
+class PtyDevice(threading.Thread):
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=None):
+        super().__init__(name=type(self).__name__, daemon=True)
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            readable, _, _ = select.select([self.master], [], [], self.nextWakeup())
+            if readable:
+                self.received(os.read(self.master, 4096))
+            self.poll()
+
+    def send(self, data):
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        os.write(self.master, data)
+
+    # overridden by the devices
+    def received(self, data):
+        pass
+
+    def poll(self):
+        pass
+
+    def nextWakeup(self):
+        return 0.05
+
+
+class SimulatedSupply(PtyDevice):
+    # SCPI subset used by models.PowerSupply, ';' separated compound commands,
+    # the replies of all queries on one line are joined with ';'.
+    # The output drives a resistive load of load_resistance ohms, or the
+    # current drawn by a SimulatedArduino motor when one is attached.
+
+    IDN = 'MECHTEX,SIMULATED SUPPLY,0,1.0'
+
+    def __init__(self, load_resistance=10.0, **kwargs):
+        super().__init__(**kwargs)
+        self.load_resistance = load_resistance
+        self.load = None
+        self._line = bytearray()
+        self.reset()
+
+    def reset(self):
+        self.voltage = 0.0
+        self.current_limit = 5.0
+        self.ovp = 80.0
+        self.output = False
+
+    def measuredVoltage(self):
+        return self.voltage if self.output else 0.0
+
+    def measuredCurrent(self):
+        if not self.output:
+            return 0.0
+        current = self.load() if self.load is not None else self.voltage / self.load_resistance
+        return min(current, self.current_limit)
+
+    def received(self, data):
+        self._line += data
+        while b'\n' in self._line:
+            line, _, rest = self._line.partition(b'\n')
+            self._line = bytearray(rest)
+            replies = [self.execute(command.strip()) for command in line.decode('ascii').split(';')]
+            replies = [reply for reply in replies if reply is not None]
+            if replies:
+                self.send((';'.join(replies) + '\n').encode('ascii'))
+
+    def execute(self, command):
+        # returns the reply text for queries, None for settings
+        header, _, argument = command.partition(' ')
+        header = header.upper()
+        queries = {
+            '*IDN?': lambda: self.IDN,
+            '*OPC?': lambda: '1',
+            'SYST:LOCK:OWN?': lambda: 'REMOTE',
+            'OUTP?': lambda: '1' if self.output else '0',
+            'SOUR:VOLT:PROT?': lambda: f'{self.ovp:.3f}',
+            'VOLT?': lambda: f'{self.voltage:.3f}',
+            'CURR?': lambda: f'{self.current_limit:.3f}',
+            'MEAS:VOLT?': lambda: f'{self.measuredVoltage():.3f}',
+            'MEAS:CURR?': lambda: f'{self.measuredCurrent():.4f}',
+            'MEAS:POW?': lambda: f'{self.measuredVoltage() * self.measuredCurrent():.3f}',
+        }
+        if header in queries:
+            return queries[header]()
+        if header == '*RST':
+            self.reset()
+        elif header == 'OUTP':
+            self.output = argument.strip().upper() in ('ON', '1')
+        elif header == 'SOUR:VOLT:PROT':
+            self.ovp = float(argument)
+        elif header == 'VOLT':
+            self.voltage = min(float(argument), self.ovp)
+        elif header == 'CURR':
+            self.current_limit = float(argument)
+        return None
+
+
+class SimulatedArduino(PtyDevice):
+    # Thrust / RPM board speaking the models.Arduino frame protocol.
+    # The motor follows PWM and supply voltage with a first order lag:
+    #   rpm -> kv * V * throttle, thrust = thrust_coefficient * rpm^2
+
+    def __init__(self, supply=None, num_poles=14, kv=1000.0, time_constant=0.15,
+                 thrust_coefficient=1e-5, noise=0.5, nominal_voltage=12.0, **kwargs):
+        super().__init__(**kwargs)
+        self.supply = supply
+        self.num_poles = num_poles
+        self.kv = kv
+        self.time_constant = time_constant
+        self.thrust_coefficient = thrust_coefficient
+        self.noise = noise
+        self.nominal_voltage = nominal_voltage
+        self.pwm = 1000
+        self.rpm = 0.0
+        self.rate = 0
+        self._command = bytearray()
+        self._next_sample = None
+        self._last_update = time.monotonic()
+        self._start = time.monotonic()
+        if supply is not None:
+            # motor current seen by the supply, roughly proportional to power
+            supply.load = lambda: 0.5 + self.thrustNow() * 0.01
+
+    def thrustNow(self):
+        return self.thrust_coefficient * self.rpm ** 2
+
+    def received(self, data):
+        self._command += data
+        size = m.Arduino.COMMAND.size
+        while len(self._command) >= size:
+            start = self._command.find(m.Arduino.COMMAND_SYNC)
+            if start < 0:
+                self._command.clear()
+                return
+            if len(self._command) - start < size:
+                del self._command[:start]
+                return
+            sync, command, value, checksum = m.Arduino.COMMAND.unpack_from(self._command, start)
+            if (command + (value & 0xFF) + (value >> 8)) & 0xFF != checksum:
+                del self._command[:start + 1]
+                continue
+            del self._command[:start + size]
+            self.execute(chr(command), value)
+
+    def execute(self, command, value):
+        if command == 'H':
+            self.send(m.Arduino.packFrame(m.Arduino.HELLO, m.Arduino.HELLO_MAGIC, 0.0, 0, 0))
+        elif command == 'P':
+            self.pwm = min(max(value, 1000), 2000)
+        elif command == 'S':
+            self.rate = value
+            self._next_sample = time.monotonic()
+        elif command == 'X':
+            self.rate = 0
+
+    def nextWakeup(self):
+        if not self.rate:
+            return 0.05
+        return max(0.0, self._next_sample - time.monotonic())
+
+    def poll(self):
+        now = time.monotonic()
+        self._updateMotor(now)
+        if not self.rate:
+            return
+        # every sample that is due, in one write
+        frames = []
+        while self._next_sample <= now:
+            timestamp = int((self._next_sample - self._start) * 1e6) & 0xFFFFFFFF
+            period = int(120e6 / (self.rpm * self.num_poles)) if self.rpm > 1 else 0
+            thrust = self.thrustNow() + self.random.gauss(0, self.noise)
+            frames.append(m.Arduino.packFrame(m.Arduino.SAMPLE, timestamp, thrust, period, self.pwm))
+            self._next_sample += 1.0 / self.rate
+        if frames:
+            self.send(b''.join(frames))
+
+    def _updateMotor(self, now):
+        voltage = self.nominal_voltage if self.supply is None else self.supply.measuredVoltage()
+        target = self.kv * voltage * (self.pwm - 1000) / 1000
+        step = min(1.0, (now - self._last_update) / self.time_constant)
+        self.rpm += (target - self.rpm) * step
+        self._last_update = now
+
+
+
+class ReplayClock:
+    # Playback position in capture time, shared by the replay devices of one
+    # capture. Runs at speed times the host clock (speed=None: jumps ahead as
+    # far as it may) from the first host write on, but never past the next
+    # recorded write of a gating device that the host has not made yet.
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.devices = []
+        self.position = math.inf
+        self._last = None
+        self._lock = threading.Lock()
+
+    def register(self, device):
+        with self._lock:
+            self.devices.append(device)
+            if device.records:
+                self.position = min(self.position, device.records[0].time)
+
+    def start(self):
+        with self._lock:
+            if self._last is None:
+                self._last = time.monotonic()
+
+    def now(self):
+        with self._lock:
+            return self._update()
+
+    def advanceTo(self, position):
+        # a gating write came in early, playback moves up to it
+        with self._lock:
+            self.position = max(self._update(), position)
+
+    def delay(self, position):
+        # host seconds until the clock reaches position
+        if not self.speed:
+            return 0.0
+        return max(0.0, (position - self.now()) / self.speed)
+
+    # Private methods
+    def _update(self):
+        limit = min([device.gate() for device in self.devices if device.gating] + [math.inf])
+        if self._last is not None:
+            host = time.monotonic()
+            if self.speed:
+                self.position += (host - self._last) * self.speed
+            else:
+                self.position = limit
+            self._last = host
+        self.position = min(self.position, limit)
+        return self.position
+
+
+class ReplayDevice(PtyDevice):
+    # Plays the traffic of one port of a capture (capture.find_channel) back
+    # on a ReplayClock, so the replay follows the host the same way every
+    # time:
+    #   gating      (the Arduino) every recorded write holds the clock until
+    #               the host writes the same bytes, the reads in between are
+    #               sent as the clock passes their recorded time. The samples
+    #               of a step are not sent before its PWM command.
+    #   non gating  (the supply) a write is answered with the reply recorded
+    #               for the same command closest before the clock, after the
+    #               recorded latency. The host may poll more or less often
+    #               than during the capture.
+    # The order of writes from different host threads (the reader's start
+    # command, the engine's PWM) is not fixed, so a gating write may come in
+    # up to `reorder` writes early: it is taken (reordered) and playback
+    # passes it once it gets there. A recorded write that is still missing
+    # reorder_timeout seconds after an early one came in is passed as well
+    # (skipped). Other writes of a gating device are answered like the
+    # supply's (repeated), or playback jumps to their next occurrence
+    # (skipped). Bytes matching no recorded write are dropped (unmatched).
+    #
+    # Without a clock all reads are played from the first host write on, as
+    # fast as the host reads them: the Arduino stream of a whole capture for
+    # profiling the acquisition pipeline (benchmark.run_replay_benchmark).
+
+    def __init__(self, records, clock=None, gating=True, reorder=4, reorder_timeout=1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.records = records
+        self.clock = clock
+        self.gating = gating
+        self.reorder = reorder
+        self.reorder_timeout = reorder_timeout
+        self.matched = self.repeated = self.reordered = self.skipped = self.unmatched = 0
+        self._times = [record.time for record in records]
+        self._host = bytearray()
+        self._output = deque()
+        self._sending = b''
+        # next record to play, for a gating device the next write stops it
+        # unless it is one of the writes already taken: index -> host time
+        self._cursor = 0
+        self._taken = {}
+        # recorded write data -> indices of the records
+        self._writes = {}
+        for index, record in enumerate(records):
+            if record.direction == WRITE:
+                self._writes.setdefault(record.data, []).append(index)
+        self._lengths = sorted({len(data) for data in self._writes}, reverse=True)
+        # index of the first write at or after every record, and the number
+        # of writes before it
+        self._nextWrite = [len(records)] * (len(records) + 1)
+        for index in range(len(records) - 1, -1, -1):
+            self._nextWrite[index] = index if records[index].direction == WRITE \
+                else self._nextWrite[index + 1]
+        self._writeCount = [0] * (len(records) + 1)
+        for index, record in enumerate(records):
+            self._writeCount[index + 1] = self._writeCount[index] + (record.direction == WRITE)
+        if clock is not None:
+            clock.register(self)
+
+    def gate(self):
+        # capture time of the next recorded write still to come, inf if
+        # there is none
+        index = self._nextWrite[self._cursor]
+        while index < len(self.records) and index in self._taken:
+            index = self._nextWrite[index + 1]
+        return self.records[index].time if index < len(self.records) else math.inf
+
+    def finished(self):
+        # everything up to the end of the capture has been sent
+        return self._cursor >= len(self.records) and not self._output and not self._sending
+
+    def run(self):
+        # the master is non blocking, a host that stops reading must not
+        # stall the commands it writes
+        os.set_blocking(self.master, False)
+        while not self._stop_event.is_set():
+            writable = [self.master] if self._sending or self._output else []
+            readable, writable, _ = select.select([self.master], writable, [], self.nextWakeup())
+            if readable:
+                try:
+                    self.received(os.read(self.master, 4096))
+                except BlockingIOError:
+                    pass
+            self.poll()
+
+    def received(self, data):
+        if self.clock is None:
+            self._queueAll()
+            return
+        self.clock.start()
+        self._host += data
+        while self._host and self._matchWrite():
+            pass
+
+    def poll(self):
+        now = time.monotonic()
+        if self.clock is not None and self.gating:
+            position = self.clock.now()
+            while self._cursor < len(self.records):
+                record = self.records[self._cursor]
+                if record.direction == READ:
+                    if record.time > position:
+                        break
+                    self._output.append((now, record.data))
+                elif self._cursor in self._taken:
+                    del self._taken[self._cursor]
+                elif self._taken and now - min(self._taken.values()) > self.reorder_timeout:
+                    # the host left this write out
+                    self.skipped += 1
+                else:
+                    break
+                self._cursor += 1
+        while not self._sending and self._output and self._output[0][0] <= now:
+            self._sending = self._output.popleft()[1]
+        if self._sending:
+            try:
+                written = os.write(self.master, self._sending)
+            except BlockingIOError:
+                written = 0
+            self._sending = self._sending[written:]
+
+    def nextWakeup(self):
+        if self._sending:
+            return 0.05
+        timeouts = [0.05]
+        if self._output:
+            timeouts.append(self._output[0][0] - time.monotonic())
+        if self.clock is not None and self.gating and self._cursor < len(self.records) \
+                and self.records[self._cursor].direction == READ:
+            timeouts.append(self.clock.delay(self.records[self._cursor].time))
+        if self._taken:
+            timeouts.append(min(self._taken.values()) + self.reorder_timeout - time.monotonic())
+        return max(0.0, min(timeouts))
+
+    # Private methods
+    def _matchWrite(self):
+        # consumes one recorded write from the host bytes, False if they
+        # may still be incomplete
+        for length in self._lengths:
+            indices = self._writes.get(bytes(self._host[:length]))
+            if indices is not None:
+                del self._host[:length]
+                if self.gating:
+                    self._gatingWrite(indices)
+                else:
+                    self._query(indices)
+                return True
+        if any(data.startswith(self._host) for data in self._writes):
+            return False
+        del self._host[:1]
+        self.unmatched += 1
+        return True
+
+    def _gatingWrite(self, indices):
+        first = bisect.bisect_left(indices, self._cursor)
+        upcoming = next((index for index in indices[first:] if index not in self._taken), None)
+        expected = self._nextWrite[self._cursor]
+        while expected < len(self.records) and expected in self._taken:
+            expected = self._nextWrite[expected + 1]
+        if upcoming is not None \
+                and self._writeCount[upcoming] - self._writeCount[expected] <= self.reorder:
+            if upcoming == expected:
+                self.matched += 1
+                # a host ahead of the capture does not wait for its pace
+                self.clock.advanceTo(self.records[upcoming].time)
+            else:
+                self.reordered += 1
+            self._taken[upcoming] = time.monotonic()
+        elif first > 0:
+            self.repeated += 1
+            self._reply(indices[first - 1])
+        elif upcoming is not None:
+            self.skipped += 1
+            self._cursor = upcoming + 1
+            self._taken = {index: taken for index, taken in self._taken.items() if index > upcoming}
+            self.clock.advanceTo(self.records[upcoming].time)
+
+    def _query(self, indices):
+        # the occurrence closest before the clock, the first one if the
+        # clock has not reached any
+        position = bisect.bisect_right(self._times, self.clock.now())
+        index = indices[max(0, bisect.bisect_left(indices, position) - 1)]
+        if index >= self._cursor:
+            self.matched += 1
+            self._cursor = index + 1
+        else:
+            self.repeated += 1
+        self._reply(index)
+
+    def _reply(self, index):
+        # the reads following the write at index, at their recorded latency
+        now = time.monotonic()
+        origin = self.records[index].time
+        for record in self.records[index + 1:]:
+            if record.direction != READ:
+                break
+            delay = (record.time - origin) / self.clock.speed if self.clock.speed else 0.0
+            self._output.append((now + delay, record.data))
+
+    def _queueAll(self):
+        now = time.monotonic()
+        for record in self.records[self._cursor:]:
+            if record.direction == READ:
+                self._output.append((now, record.data))
+        self._cursor = len(self.records)
@@ -0,0 +1,256 @@
+import abc
+import csv
+import json
+import os
+import threading
+import time
+import numpy as np
+
+# Result files
+#
+# Samples are written while they are acquired: rows are buffered in memory
+# until a batch is full or fsync_interval seconds have passed since the last
+# sync, then written out and the file is fsync'ed. A run of any length uses
+# constant memory and a crash (or a lost USB link) loses at most the rows of
+# the last fsync_interval seconds.
+
+
+SUPPLY_DTYPE = np.dtype([
+    ('time', 'f8'), ('voltage', 'f8'), ('current', 'f8'),
+])
+ARDUINO_DTYPE = np.dtype([
+    ('time', 'f8'), ('timestamp', 'u4'), ('thrust', 'f4'), ('period', 'u4'), ('pwm', 'u2'),
+])
+
+
+class BatchedWriter(abc.ABC):
+    # Common buffering / fsync logic, subclasses implement _writeRows(),
+    # _sync() and _close()
+
+    def __init__(self, path, batch_size=1000, fsync_interval=5.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.rows_written = 0
+        self._pending = []
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def write(self, row):
+        with self._lock:
+            self._pending.append(row)
+            if self._due():
+                self._flushPending()
+
+    def writeMany(self, rows):
+        with self._lock:
+            self._pending.extend(rows)
+            if self._due():
+                self._flushPending()
+
+    def flush(self, sync=False):
+        with self._lock:
+            self._flushPending(sync)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._flushPending(sync=True)
+            self._close()
+            self._closed = True
+
+    # Private methods
+    def _due(self):
+        # slow streams (the supply at ~20 Hz) are written by time, not count
+        return len(self._pending) >= self.batch_size \
+            or time.monotonic() - self._last_sync >= self.fsync_interval
+
+    def _flushPending(self, sync=False):
+        if self._pending:
+            self._writeRows(self._pending)
+            self.rows_written += len(self._pending)
+            self._pending = []
+        now = time.monotonic()
+        if sync or now - self._last_sync >= self.fsync_interval:
+            self._sync()
+            self._last_sync = now
+
+    @abc.abstractmethod
+    def _writeRows(self, rows):
+        pass
+
+    @abc.abstractmethod
+    def _sync(self):
+        pass
+
+    @abc.abstractmethod
+    def _close(self):
+        pass
+
+
+class CsvResultWriter(BatchedWriter):
+
+    def __init__(self, path, fields, **kwargs):
+        super().__init__(path, **kwargs)
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(fields)
+
+    def _writeRows(self, rows):
+        self.writer.writerows(rows)
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def _close(self):
+        self.file.close()
+
+
+class NpyResultWriter(BatchedWriter):
+    # Appends rows of a structured dtype to a .npy file through a memory map.
+    # The file grows chunk_rows at a time, the header is rewritten with the
+    # number of valid rows after every batch, so np.load() always sees a
+    # consistent array, even if the run is cut off.
+    #
+    #   np.load(path, mmap_mode='r')['thrust']
+
+    def __init__(self, path, dtype, chunk_rows=65536, **kwargs):
+        super().__init__(path, **kwargs)
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.file = open(path, 'w+b')
+        self.capacity = 0
+        self._map = None
+        # the header is padded to a fixed size big enough for any row count,
+        # so it can be rewritten in place
+        self.header_size = len(self._header(10 ** 15, pad=False)) // 64 * 64 + 64
+        self._writeHeader()
+
+    def _header(self, count, pad=True):
+        header = repr({
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (count,),
+        }).encode('latin1')
+        prefix = np.lib.format.magic(1, 0)
+        length = len(prefix) + 2 + len(header) + 1
+        padding = self.header_size - length if pad else 0
+        header += b' ' * padding + b'\n'
+        return prefix + (len(header)).to_bytes(2, 'little') + header
+
+    def _writeHeader(self):
+        self.file.seek(0)
+        self.file.write(self._header(self.rows_written))
+        self.file.flush()
+
+    def _reserve(self, count):
+        if count <= self.capacity:
+            return
+        while self.capacity < count:
+            self.capacity += self.chunk_rows
+        if self._map is not None:
+            self._map.flush()
+            self._map = None
+        self.file.truncate(self.header_size + self.capacity * self.dtype.itemsize)
+        self._map = np.memmap(
+            self.file, dtype=self.dtype, mode='r+',
+            offset=self.header_size, shape=(self.capacity,)
+        )
+
+    def _writeRows(self, rows):
+        start = self.rows_written
+        self._reserve(start + len(rows))
+        self._map[start:start + len(rows)] = np.array(rows, dtype=self.dtype)
+        self._map.flush()
+        # header last, so it never counts rows that are not in the file yet
+        self.file.seek(0)
+        self.file.write(self._header(start + len(rows)))
+        self.file.flush()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+
+    def _close(self):
+        self._map = None
+        self.file.truncate(self.header_size + self.rows_written * self.dtype.itemsize)
+        self._writeHeader()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+def open_result_writer(path, dtype, format='csv', **kwargs):
+    # path without extension, '.csv' or '.npy' is added
+    if format == 'npy':
+        return NpyResultWriter(path + '.npy', dtype, **kwargs)
+    if format == 'csv':
+        return CsvResultWriter(path + '.csv', np.dtype(dtype).names, **kwargs)
+    raise ValueError(f'Unknown result format {format!r}')
+
+
+class RunWriter:
+    # Writes one run next to data['dest_file']:
+    #   <dest_file>.csv          averaged result of every sweep step
+    #   <dest_file>_supply.*     every supply reading
+    #   <dest_file>_arduino.*    every Arduino sample
+    #   <dest_file>_meta.json    the setup data of the run, if given, and what
+    #                            annotate() adds (e.g. the transport delays)
+    # With a results.ResultStore the run and its steps are also recorded in
+    # the results database, the steps in one insert when the run is closed.
+    # It is a telemetry sink, add it to DeviceWorker.sinks.
+
+    def __init__(self, dest_file, step_fields, format='csv', metadata=None, store=None, **kwargs):
+        dest_file = os.path.splitext(dest_file)[0]
+        self.dest_file = dest_file
+        self.metadata = None if metadata is None else dict(metadata)
+        self._writeMetadata()
+        self.store = store
+        self.run_id = None
+        self.closed = False
+        # step results not in the database yet
+        self._storeSteps = []
+        if store is not None:
+            self.run_id = store.startRun(dict(metadata or {}, dest_file=dest_file))
+        self.steps = CsvResultWriter(dest_file + '.csv', step_fields, batch_size=1)
+        self.supply = open_result_writer(dest_file + '_supply', SUPPLY_DTYPE, format, **kwargs)
+        self.arduino = open_result_writer(dest_file + '_arduino', ARDUINO_DTYPE, format, **kwargs)
+
+    def __call__(self, kind, timestamp, payload):
+        if kind == 'supply':
+            self.supply.write((timestamp, payload.voltage, payload.current))
+        else:
+            self.arduino.writeMany([(timestamp, *sample) for sample in payload])
+
+    def writeStep(self, result):
+        self.steps.write(result)
+        self.steps.flush(sync=True)
+        if self.store is not None:
+            self._storeSteps.append(result)
+
+    def annotate(self, **fields):
+        # adds fields to the metadata file (runs without metadata have none)
+        if self.metadata is not None:
+            self.metadata.update(fields)
+            self._writeMetadata()
+
+    def close(self, error=None):
+        # error: why the run stopped, None if it completed. Only the first
+        # call records the run's status.
+        if self.closed:
+            return
+        self.closed = True
+        self.steps.close()
+        self.supply.close()
+        self.arduino.close()
+        if self.store is not None:
+            self.store.addSteps(self.run_id, self._storeSteps)
+            self._storeSteps = []
+            self.store.finishRun(self.run_id, error)
+
+    # Private methods
+    def _writeMetadata(self):
+        if self.metadata is not None:
+            with open(self.dest_file + '_meta.json', 'w') as file:
+                json.dump(self.metadata, file, indent=2, default=str)
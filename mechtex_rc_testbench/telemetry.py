@@ -0,0 +1,125 @@
+import numpy as np
+
+# Live telemetry storage
+#
+# Every channel is a preallocated NumPy ring buffer, appending writes into the
+# existing array, and the windowed statistics over the last n samples are a
+# handful of numpy calls on (at most two) slices of it.
+
+
+class RingBuffer:
+
+    def __init__(self, capacity, dtype='f8'):
+        self.capacity = capacity
+        self.data = np.zeros(capacity, dtype=dtype)
+        # total number of values ever appended, the next write goes to
+        # count % capacity
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, value):
+        self.data[self.count % self.capacity] = value
+        self.count += 1
+
+    def extend(self, values):
+        # only the last capacity values can survive, skip the rest
+        skipped = max(0, len(values) - self.capacity)
+        values = values[skipped:]
+        start = (self.count + skipped) % self.capacity
+        first = min(len(values), self.capacity - start)
+        self.data[start:start + first] = values[:first]
+        self.data[:len(values) - first] = values[first:]
+        self.count += skipped + len(values)
+
+    def latest(self):
+        if not self.count:
+            return np.nan
+        return self.data[(self.count - 1) % self.capacity]
+
+    def segments(self, n):
+        # the last n values as one or two views (oldest first), no copy
+        n = min(n, len(self))
+        end = self.count % self.capacity
+        if n <= end:
+            return (self.data[end - n:end],)
+        return (self.data[self.capacity - (n - end):], self.data[:end])
+
+    def window(self, n):
+        # the last n values as one array, copies only when the window wraps
+        segments = self.segments(n)
+        return segments[0] if len(segments) == 1 else np.concatenate(segments)
+
+    def mean(self, n):
+        segments = self.segments(n)
+        size = sum(len(segment) for segment in segments)
+        if not size:
+            return np.nan
+        return sum(segment.sum() for segment in segments) / size
+
+    def std(self, n):
+        window = self.window(n)
+        return window.std() if len(window) else np.nan
+
+    def min(self, n):
+        segments = [segment for segment in self.segments(n) if len(segment)]
+        return min(segment.min() for segment in segments) if segments else np.nan
+
+    def max(self, n):
+        segments = [segment for segment in self.segments(n) if len(segment)]
+        return max(segment.max() for segment in segments) if segments else np.nan
+
+    def stats(self, n):
+        return {'mean': self.mean(n), 'std': self.std(n), 'min': self.min(n), 'max': self.max(n)}
+
+
+class TelemetryBuffer:
+    # One ring buffer per channel plus the host receive times of each source.
+    # It is a telemetry sink (see workers.DeviceWorker), the supply channels
+    # are written by the device worker and the Arduino channels by the
+    # ArduinoReader, readers (dashboard, sweep engine) only look at windows.
+    #
+    #   telemetry['thrust'].mean(data['num_readings'])
+
+    SOURCES = {
+        'supply': ('voltage', 'current'),
+        'arduino': ('thrust', 'rpm', 'pwm'),
+    }
+
+    def __init__(self, num_poles, capacity=65536):
+        self.num_poles = num_poles
+        self.capacity = capacity
+        self.channels = {}
+        self.times = {}
+        for source, channels in self.SOURCES.items():
+            self.times[source] = RingBuffer(capacity)
+            for channel in channels:
+                self.channels[channel] = RingBuffer(capacity)
+
+    def __getitem__(self, channel):
+        return self.channels[channel]
+
+    def __call__(self, kind, timestamp, payload):
+        if kind == 'supply':
+            self.channels['voltage'].append(payload.voltage)
+            self.channels['current'].append(payload.current)
+            self.times['supply'].append(timestamp)
+            return
+        # one array per batch of samples: columns timestamp, thrust, period, pwm
+        block = np.array(payload, dtype='f8').reshape(-1, 4)
+        period = block[:, 2]
+        rpm = np.divide(
+            120e6, period * self.num_poles,
+            out=np.zeros_like(period), where=period > 0
+        )
+        self.channels['thrust'].extend(block[:, 1])
+        self.channels['rpm'].extend(rpm)
+        self.channels['pwm'].extend(block[:, 3])
+        self.times['arduino'].extend(np.full(len(block), timestamp))
+
+    def count(self, source):
+        return self.times[source].count
+
+    def latest(self):
+        return {channel: buffer.latest() for channel, buffer in self.channels.items()}
@@ -11,6 +11,8 @@ class SetupPage(ttk.Frame):
         self.arduino_port = tk.StringVar()
         self.numPoles = tk.IntVar()
         self.numReadings = tk.IntVar()
+        self.motor = tk.StringVar()
+        self.prop = tk.StringVar()
         self.maxV = tk.DoubleVar()
         self.maxI = tk.DoubleVar()
         self.maxT = tk.DoubleVar()
@@ -43,10 +45,10 @@ class SetupPage(ttk.Frame):
         # creating param_frame
         # -------------------------------------------------------------------------------
         # configuring rows and columns
-        self.param_frame.grid_rowconfigure([0], weight=1)
+        self.param_frame.grid_rowconfigure([0, 1], weight=1)
         self.param_frame.grid_columnconfigure([0, 1], weight=1)
         # creating inner frames
-        self.param_inner_fr = [ttk.Frame(self.param_frame) for i in range(2)]
+        self.param_inner_fr = [ttk.Frame(self.param_frame) for i in range(4)]
         ttk.Label(self.param_inner_fr[0], text='Number of Poles: ').grid(
             row=0, column=0, padx=2, pady=2
         )
@@ -58,8 +60,16 @@ class SetupPage(ttk.Frame):
         self.numReadings_entry = ttk.Entry(self.param_inner_fr[1], width=15, textvariable=self.numReadings)
         self.numReadings_entry.grid(row=0, column=1, padx=2, pady=2)
         ttk.Label(self.param_inner_fr[1], text='(for averaging)').grid(row=1, column=0)
+        ttk.Label(self.param_inner_fr[2], text='Motor: ').grid(row=0, column=0, padx=2, pady=2)
+        ttk.Label(self.param_inner_fr[3], text='Propeller: ').grid(row=0, column=0, padx=2, pady=2)
+        self.motor_entry = ttk.Entry(self.param_inner_fr[2], width=15, textvariable=self.motor)
+        self.motor_entry.grid(row=0, column=1, padx=2, pady=2)
+        self.prop_entry = ttk.Entry(self.param_inner_fr[3], width=15, textvariable=self.prop)
+        self.prop_entry.grid(row=0, column=1, padx=2, pady=2)
         self.param_inner_fr[0].grid(row=0, column=0, padx=2, pady=2)
         self.param_inner_fr[1].grid(row=0, column=1, padx=2, pady=2)
+        self.param_inner_fr[2].grid(row=1, column=0, padx=2, pady=2, sticky=tk.E)
+        self.param_inner_fr[3].grid(row=1, column=1, padx=2, pady=2, sticky=tk.E)
         
         # -------------------------------------------------------------------------------
         # Creating Ports Frame
@@ -76,6 +86,8 @@ class SetupPage(ttk.Frame):
         self.arduino_port_menu = ttk.OptionMenu(self.ports_frame, self.arduino_port)
         self.arduino_port_menu.grid(row=2, column=1, padx=2, pady=2)
         
+        self.rescan_button = ttk.Button(self.ports_frame, text='Re-scan All')
+        self.rescan_button.grid(row=3, column=0, pady=2, sticky=tk.W)
         self.refresh_button = ttk.Button(self.ports_frame, text='Refresh Ports')
         self.refresh_button.grid(row=3, column=1, pady=2, sticky=tk.E)
         
@@ -172,6 +184,8 @@ class SetupPage(ttk.Frame):
         self.button_auto.grid(row=0, column=1, padx=2, pady=2)
         self.button_manual = ttk.Button(self.start_frame, text='Manual Testing')
         self.button_manual.grid(row=0, column=2, padx=2, pady=2)
+        self.button_debug = ttk.Button(self.start_frame, text='Diagnostics')
+        self.button_debug.grid(row=0, column=3, padx=2, pady=2)
         
         
         
@@ -218,6 +232,8 @@ class SetupPage(ttk.Frame):
         data = {}
         data['num_poles'] = self.numPoles.get()
         data['num_readings'] = self.numReadings.get()
+        data['motor'] = self.motor.get()
+        data['prop'] = self.prop.get()
         data['supply_port'] = self.supply_port.get()
         data['arduino_port'] = self.arduino_port.get()
         data['max_voltage'] = self.maxV.get()
@@ -235,7 +251,7 @@ class ManualPage(ttk.LabelFrame):
     def __init__(self, container, controller):
         super().__init__(container)
         self.grid_rowconfigure(2, weight=1)
-        self.grid_columnconfigure([2, 4, 6], weight=1)
+        self.grid_columnconfigure([2, 4, 6, 8], weight=1)
         
         # -------------------------------------------------------------------------------
         # Creating all Manual Frames
@@ -244,6 +260,7 @@ class ManualPage(ttk.LabelFrame):
         self.pwm_frame = ttk.LabelFrame(self, text='PWM Control')
         self.voltage_frame = ttk.LabelFrame(self, text='Voltage Control')
         self.dashboard = ttk.LabelFrame(self, text='Dashboard')
+        self.plot_frame = ttk.LabelFrame(self, text='Live Plot')
         # Add info frame???
 
         # -------------------------------------------------------------------------------
@@ -308,21 +325,21 @@ class ManualPage(ttk.LabelFrame):
         ttk.Label(self.dashboard, text='RPM: ').grid(
             row=10, column=2, padx=2, pady=2
         )
-        self.dash_voltage = ttk.Label(self.dashboard, text='').grid(
-            row=2, column=4, padx=2, pady=2
-        )
-        self.dash_pwm = ttk.Label(self.dashboard, text='').grid(
-            row=4, column=4, padx=2, pady=2
-        )
-        self.dash_current = ttk.Label(self.dashboard, text='').grid(
-            row=6, column=4, padx=2, pady=2
-        )
-        self.dash_thrust = ttk.Label(self.dashboard, text='').grid(
-            row=8, column=4, padx=2, pady=2
-        )
-        self.dash_rpm = ttk.Label(self.dashboard, text='').grid(
-            row=10, column=4, padx=2, pady=2
-        )
+        # readouts, updated through updateDashboard()
+        self.dash_vars = {
+            name: tk.StringVar() for name in ('voltage', 'pwm', 'current', 'thrust', 'rpm')
+        }
+        self._dash_text = {}
+        self.dash_voltage = ttk.Label(self.dashboard, textvariable=self.dash_vars['voltage'])
+        self.dash_voltage.grid(row=2, column=4, padx=2, pady=2)
+        self.dash_pwm = ttk.Label(self.dashboard, textvariable=self.dash_vars['pwm'])
+        self.dash_pwm.grid(row=4, column=4, padx=2, pady=2)
+        self.dash_current = ttk.Label(self.dashboard, textvariable=self.dash_vars['current'])
+        self.dash_current.grid(row=6, column=4, padx=2, pady=2)
+        self.dash_thrust = ttk.Label(self.dashboard, textvariable=self.dash_vars['thrust'])
+        self.dash_thrust.grid(row=8, column=4, padx=2, pady=2)
+        self.dash_rpm = ttk.Label(self.dashboard, textvariable=self.dash_vars['rpm'])
+        self.dash_rpm.grid(row=10, column=4, padx=2, pady=2)
         
         # -------------------------------------------------------------------------------
         # Creating buttons
@@ -341,6 +358,83 @@ class ManualPage(ttk.LabelFrame):
         self.pwm_frame.grid(row=2, column=2, sticky=tk.NSEW)
         self.voltage_frame.grid(row=2, column=4, sticky=tk.NSEW)
         self.dashboard.grid(row=2, column=6, sticky=tk.NSEW)
+        self.plot_frame.grid(row=2, column=8, sticky=tk.NSEW)
+    
+    def updateDashboard(self, text):
+        # text maps readout name -> formatted value, only readouts whose
+        # text changed are touched
+        for name, value in text.items():
+            if self._dash_text.get(name) != value:
+                self._dash_text[name] = value
+                self.dash_vars[name].set(value)
+
+
+class DebugPanel(tk.Toplevel):
+    # Device I/O statistics (instrumentation.Stats.snapshot()), refreshed by
+    # the controller through show()
+    LATENCY_COLUMNS = ('count', 'mean', 'p50', 'p95', 'p99', 'max')
+    
+    def __init__(self, master):
+        super().__init__(master)
+        self.title('Diagnostics')
+        self.grid_rowconfigure(0, weight=3)
+        self.grid_rowconfigure(1, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+        
+        self.latency_frame = ttk.LabelFrame(self, text='Latency (ms)')
+        self.latency_frame.grid_rowconfigure(0, weight=1)
+        self.latency_frame.grid_columnconfigure(0, weight=1)
+        self.latency_tree = ttk.Treeview(
+            self.latency_frame,
+            columns=self.LATENCY_COLUMNS,
+            height=12
+        )
+        self.latency_tree.heading('#0', text='operation')
+        self.latency_tree.column('#0', width=260)
+        for column in self.LATENCY_COLUMNS:
+            self.latency_tree.heading(column, text=column)
+            self.latency_tree.column(column, width=70, anchor=tk.E)
+        self.latency_tree.grid(row=0, column=0, sticky=tk.NSEW)
+        
+        self.counter_frame = ttk.LabelFrame(self, text='Counters and queues')
+        self.counter_frame.grid_rowconfigure(0, weight=1)
+        self.counter_frame.grid_columnconfigure(0, weight=1)
+        self.counter_tree = ttk.Treeview(self.counter_frame, columns=('value', 'max'), height=8)
+        self.counter_tree.heading('#0', text='name')
+        self.counter_tree.column('#0', width=260)
+        for column in ('value', 'max'):
+            self.counter_tree.heading(column, text=column)
+            self.counter_tree.column(column, width=90, anchor=tk.E)
+        self.counter_tree.grid(row=0, column=0, sticky=tk.NSEW)
+        
+        self.button_frame = ttk.Frame(self)
+        self.reset_button = ttk.Button(self.button_frame, text='Reset')
+        self.reset_button.grid(row=0, column=0, padx=2, pady=2)
+        self.export_button = ttk.Button(self.button_frame, text='Export')
+        self.export_button.grid(row=0, column=1, padx=2, pady=2)
+        
+        self.latency_frame.grid(row=0, column=0, padx=2, pady=2, sticky=tk.NSEW)
+        self.counter_frame.grid(row=1, column=0, padx=2, pady=2, sticky=tk.NSEW)
+        self.button_frame.grid(row=2, column=0, padx=2, pady=2, sticky=tk.E)
+    
+    def show(self, snapshot):
+        # rows are reused by key, so the selection and scroll position stay
+        for key, summary in snapshot['latency_ms'].items():
+            values = [summary.get('count', 0)] + [
+                f'{summary[column]:.3f}' if column in summary else ''
+                for column in self.LATENCY_COLUMNS[1:]
+            ]
+            self._setRow(self.latency_tree, key, values)
+        for key, value in snapshot['counters'].items():
+            self._setRow(self.counter_tree, key, [value, ''])
+        for key, gauge in snapshot['gauges'].items():
+            self._setRow(self.counter_tree, key, [gauge['last'], gauge['max']])
+    
+    def _setRow(self, tree, key, values):
+        if tree.exists(key):
+            tree.item(key, values=values)
+        else:
+            tree.insert('', 'end', iid=key, text=key, values=values)
 
 
 # if __name__ == '__main__':
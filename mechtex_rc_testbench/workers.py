@@ -0,0 +1,350 @@
+import queue
+import serial
+import threading
+import time
+from concurrent.futures import Future
+from . import alignment as al
+from . import interlock as i
+from . import models as m
+
+
+class CoalescingChannel:
+    # Latest-value-wins setpoints. put() overwrites a value that has not been
+    # sent yet, so a fast slider drag leaves at most one pending setpoint per
+    # channel instead of a backlog. Each channel is sent at most max_rate
+    # times per second.
+    #
+    #   setpoints.put(('supply', 'setVoltage'), 12.5)
+
+    def __init__(self, max_rate=20.0):
+        self.min_interval = 1.0 / max_rate
+        # called with (key, future) after each setpoint was sent
+        self.done_callback = None
+        # set by the consumer, called when a channel gets a new pending value
+        self.wakeup = None
+        self._pending = {}
+        self._last_sent = {}
+        self._lock = threading.Lock()
+
+    def put(self, key, value):
+        with self._lock:
+            was_pending = key in self._pending
+            self._pending[key] = value
+        if not was_pending and self.wakeup is not None:
+            self.wakeup()
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+
+    def __len__(self):
+        # number of setpoints waiting to be sent
+        return len(self._pending)
+
+    def nextDue(self):
+        # seconds until the next pending setpoint may be sent, None if idle
+        with self._lock:
+            if not self._pending:
+                return None
+            now = time.monotonic()
+            return max(0.0, min(
+                self._last_sent.get(key, 0.0) + self.min_interval - now
+                for key in self._pending
+            ))
+
+    def takeDue(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            for key in list(self._pending):
+                if now - self._last_sent.get(key, 0.0) >= self.min_interval:
+                    due.append((key, self._pending.pop(key)))
+                    self._last_sent[key] = now
+        return due
+
+
+class DeviceWorker(threading.Thread):
+    # Owns the serial ports: the devices are opened, used and closed only on
+    # this thread. Everybody else submits commands through the queue and gets
+    # a Future back, so a slow instrument never blocks the caller.
+    #
+    #   worker = DeviceWorker(data['supply_port'], data['arduino_port'])
+    #   worker.start()
+    #   worker.submit('supply', 'setVoltage', 12.0)
+    #   voltage = worker.call('supply', 'getActualVoltage')
+    #
+    # Setpoints put on the CoalescingChannel are sent between commands at the
+    # channel's rate, keyed by (device, method name).
+    #
+    # With a telemetry_interval the supply is measured whenever the queue is
+    # idle and the interval has elapsed. Every telemetry sink is called with
+    # ('supply', host time, Measurement) on this thread, ArduinoReader publishes
+    # ('arduino', host time, [ArduinoSample, ...]) to the same sinks.
+    # Supply readings are stamped in the middle of the query, see
+    # alignment.py for the transport delays in transport_delay.
+
+    # queued to wake the thread when a setpoint arrives
+    _WAKE = object()
+
+    # instrumentation.Stats while instrumentation is enabled
+    stats = None
+
+    # written by trip(), motor first
+    trip_commands = (
+        ('arduino', 'setPWM', 1000),
+        ('supply', 'setVoltage', 0),
+        ('supply', 'turnOutputOFF'),
+    )
+
+    def __init__(self, supply_port, arduino_port=None, setpoints=None, telemetry_interval=None):
+        super().__init__(name='device-worker', daemon=True)
+        self.supply_port = supply_port
+        self.arduino_port = arduino_port
+        self.setpoints = setpoints if setpoints is not None else CoalescingChannel()
+        self.setpoints.wakeup = lambda: self.commands.put(self._WAKE)
+        self.telemetry_interval = telemetry_interval
+        self.sinks = []
+        self.devices = {}
+        self.commands = queue.Queue()
+        # set once the ports are open (or failed to open, see self.error)
+        self.ready = threading.Event()
+        self.error = None
+        self._closed = False
+        # held while a command is queued and while the worker closes, so a
+        # command is either refused or queued before the final drain
+        self._submitLock = threading.Lock()
+        self._next_telemetry = 0.0
+        self.telemetry_errors = 0
+        # one-way delay estimates per device (s)
+        self.transport_delay = {'supply': al.DelayEstimate(), 'arduino': al.DelayEstimate()}
+        # SafetyLimitError of the last trip(), None while not tripped
+        self.tripped = None
+        # held while an energizing command is checked and written, so it
+        # cannot land after the cut-off
+        self._tripLock = threading.Lock()
+
+    def submit(self, device, name, *args):
+        future = Future()
+        if self.stats is not None:
+            future.submitted = time.perf_counter()
+        with self._submitLock:
+            closed = self._closed
+            if not closed:
+                self.commands.put((device, name, args, future))
+        if closed:
+            future.set_exception(serial.SerialException('Device worker is stopped'))
+        return future
+
+    def call(self, device, name, *args, timeout=None):
+        # blocking helper for non-GUI threads
+        return self.submit(device, name, *args).result(timeout)
+
+    def publish(self, kind, timestamp, payload):
+        if self.stats is None:
+            for sink in self.sinks:
+                sink(kind, timestamp, payload)
+            return
+        start = time.perf_counter()
+        for sink in self.sinks:
+            sink(kind, timestamp, payload)
+        self.stats.latency(f'publish.{kind}', time.perf_counter() - start)
+
+    def trip(self, reason):
+        # Priority path for the interlock, runs on the caller's thread: the
+        # cut-off commands are written straight to the ports (BufferedSerial
+        # serializes the writes), queued commands and setpoints are dropped.
+        # Until resetTrip() commands that would power the motor are refused.
+        with self._tripLock:
+            self.tripped = reason
+        self.setpoints.clear()
+        if 'supply' in self.devices:
+            # the cut-off is always written, whatever the cache holds
+            self.devices['supply'].invalidateCache()
+        for device, name, *args in self.trip_commands:
+            try:
+                getattr(self.devices[device], name)(*args)
+            except (KeyError, serial.SerialException, OSError):
+                # port missing or gone, the other device is still cut off
+                pass
+        self._failPending(reason, keep_stop=True)
+
+    def transportDelays(self):
+        # median one-way delay per device (s), None before the first sample
+        return {device: delay.median() for device, delay in self.transport_delay.items()}
+
+    def resetTrip(self):
+        self.tripped = None
+
+    def stop(self):
+        # commands queued before stop() are still executed, then ports close
+        self.commands.put(None)
+
+    def run(self):
+        error = serial.SerialException('Device worker is stopped')
+        try:
+            self._openDevices()
+            self.ready.set()
+            while True:
+                try:
+                    command = self.commands.get(timeout=self._nextWakeup())
+                except queue.Empty:
+                    command = self._WAKE
+                if command is None:
+                    break
+                if command is not self._WAKE:
+                    self._execute(*command)
+                self._sendSetpoints()
+                self._sampleTelemetry()
+        except Exception as exc:
+            error = exc
+            self.error = exc
+        finally:
+            with self._submitLock:
+                self._closed = True
+            self.ready.set()
+            self._closeDevices()
+            self._failPending(error)
+
+    # Private methods
+    def _openDevices(self):
+        self.devices['supply'] = m.PowerSupply(self.supply_port)
+        if self.arduino_port:
+            self.devices['arduino'] = m.Arduino(self.arduino_port)
+            self.transport_delay['arduino'].add(self.devices['arduino'].handshake_rtt / 2)
+
+    def _closeDevices(self):
+        for device in self.devices.values():
+            device.close()
+        self.devices.clear()
+
+    def _execute(self, device, name, args, future):
+        if not future.set_running_or_notify_cancel():
+            return
+        if self.stats is not None:
+            self._recordExecute(device, name, args, future)
+            return
+        self._call(device, name, args, future)
+
+    def _recordExecute(self, device, name, args, future):
+        start = time.perf_counter()
+        if hasattr(future, 'submitted'):
+            self.stats.latency('worker.queue_wait', start - future.submitted)
+        self.stats.gauge('worker.queue_depth', self.commands.qsize())
+        self.stats.gauge('worker.setpoints_pending', len(self.setpoints))
+        self._call(device, name, args, future)
+        self.stats.latency(f'{device}.{name}', time.perf_counter() - start)
+        if future.exception() is not None:
+            self.stats.count('worker.errors')
+
+    def _call(self, device, name, args, future):
+        try:
+            if device not in self.devices:
+                raise serial.SerialException(f'No {device} connected')
+            method = getattr(self.devices[device], name)
+            if self._energizes(name, args):
+                with self._tripLock:
+                    if self.tripped is not None:
+                        raise i.SafetyLimitError(f'Interlock tripped ({self.tripped}), {name} refused')
+                    result = method(*args)
+            else:
+                result = method(*args)
+        except Exception as error:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _nextWakeup(self):
+        timeouts = [self.setpoints.nextDue()]
+        if self.telemetry_interval is not None:
+            timeouts.append(max(0.0, self._next_telemetry - time.monotonic()))
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def _sampleTelemetry(self):
+        if self.telemetry_interval is None or time.monotonic() < self._next_telemetry:
+            return
+        sent = time.monotonic()
+        self._next_telemetry = sent + self.telemetry_interval
+        try:
+            measurement = self.devices['supply'].measure(['VOLT', 'CURR'])
+        except (serial.SerialException, ValueError):
+            # a garbled or late reply only costs this sample
+            self.telemetry_errors += 1
+            if self.stats is not None:
+                self.stats.count('worker.telemetry_errors')
+            return
+        # the supply measured somewhere in the round trip, most likely halfway
+        received = time.monotonic()
+        self.transport_delay['supply'].add((received - sent) / 2)
+        self.publish('supply', (sent + received) / 2, measurement)
+
+    def _sendSetpoints(self):
+        for (device, name), value in self.setpoints.takeDue():
+            future = Future()
+            self._execute(device, name, (value,), future)
+            if self.setpoints.done_callback is not None:
+                self.setpoints.done_callback((device, name), future)
+
+    @staticmethod
+    def _energizes(name, args):
+        return name == 'turnOutputON' \
+            or (name == 'setVoltage' and float(args[0]) > 0) \
+            or (name == 'setPWM' and float(args[0]) > 1000)
+
+    def _failPending(self, error, keep_stop=False):
+        stop = False
+        while True:
+            try:
+                command = self.commands.get_nowait()
+            except queue.Empty:
+                break
+            if command is None:
+                stop = True
+            elif command is not self._WAKE and command[3].set_running_or_notify_cancel():
+                command[3].set_exception(error)
+        if stop and keep_stop:
+            self.commands.put(None)
+
+
+class ArduinoReader(threading.Thread):
+    # Acquisition thread for the Arduino stream. The port is owned by the
+    # device worker (commands, PWM), this thread only reads from it, so the
+    # stream is drained while the worker is busy talking to the supply.
+    # stop() queues stopStream on the worker, so call it before stopping the
+    # worker.
+
+    def __init__(self, worker, rate=1000):
+        super().__init__(name='arduino-reader', daemon=True)
+        self.worker = worker
+        self.rate = rate
+        self._stop_event = threading.Event()
+        self._streaming = False
+        # startStream is never queued after stopStream
+        self._streamLock = threading.Lock()
+
+    def stop(self):
+        with self._streamLock:
+            self._stop_event.set()
+            if self._streaming:
+                self._streaming = False
+                self.worker.submit('arduino', 'stopStream')
+
+    def run(self):
+        self.worker.ready.wait()
+        arduino = self.worker.devices.get('arduino')
+        if arduino is None:
+            return
+        with self._streamLock:
+            if self._stop_event.is_set():
+                return
+            self._streaming = True
+            started = self.worker.submit('arduino', 'startStream', self.rate)
+        started.result()
+        try:
+            while not self._stop_event.is_set():
+                samples = arduino.readSamples()
+                if samples:
+                    self.worker.publish('arduino', time.monotonic(), samples)
+        except serial.SerialException:
+            # port closed underneath us by the worker shutting down
+            return
@@ -0,0 +1,22 @@
+import pytest
+
+# the simulated devices answer on pseudo terminals (Linux / macOS)
+pytest.importorskip('pty')
+
+from mechtex_rc_testbench import simulation as sim
+
+
+@pytest.fixture
+def simulated_supply():
+    supply = sim.SimulatedSupply()
+    supply.start()
+    yield supply
+    supply.stop()
+
+
+@pytest.fixture
+def simulated_arduino(simulated_supply):
+    arduino = sim.SimulatedArduino(supply=simulated_supply)
+    arduino.start()
+    yield arduino
+    arduino.stop()
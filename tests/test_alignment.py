@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from mechtex_rc_testbench import alignment as al
+
+RIGHT = [1.0, 2.0, 3.0]
+LEFT = [0.5, 1.0, 1.4, 1.6, 3.5]
+
+
+@pytest.mark.parametrize('direction, expected', [
+    ('backward', [-1, 0, 0, 0, 2]),
+    ('forward', [0, 0, 1, 1, -1]),
+    ('nearest', [0, 0, 0, 1, 2]),
+])
+def test_merge_asof_directions(direction, expected):
+    assert list(al.merge_asof(LEFT, RIGHT, direction)) == expected
+
+
+def test_merge_asof_tolerance():
+    assert list(al.merge_asof(LEFT, RIGHT, 'nearest', tolerance=0.45)) == [-1, 0, 0, 1, -1]
+    assert list(al.merge_asof(LEFT, RIGHT, 'backward', tolerance=0.45)) == [-1, 0, 0, -1, -1]
+
+
+def test_merge_asof_without_right_times():
+    assert list(al.merge_asof(LEFT, [], 'nearest')) == [-1] * len(LEFT)
+
+
+def test_merge_asof_unknown_direction():
+    with pytest.raises(ValueError):
+        al.merge_asof(LEFT, RIGHT, 'sideways')
+
+
+def test_interpolate_is_nan_outside_and_beyond_tolerance():
+    result = al.interpolate([0.5, 1.5, 2.5, 3.5], RIGHT, [10.0, 20.0, 40.0], tolerance=1.0)
+    assert np.isnan(result[0]) and np.isnan(result[3])
+    assert list(result[1:3]) == [15.0, 30.0]
+
+
+def test_unwrap_board_time_across_the_u32_wrap():
+    seconds = al.unwrap_board_time([(1 << 32) - 1000, (1 << 32) - 1, 5, 1000])
+    assert np.diff(seconds) == pytest.approx([999e-6, 6e-6, 995e-6])
+
+
+def test_board_to_host_uses_the_least_delayed_samples():
+    board = np.arange(0, 2_000_000, 10_000)
+    # batches arrive 1 to 10 ms late, the clocks are 100 s apart
+    late = 0.001 + 0.009 * (np.arange(len(board)) % 7) / 6
+    host = 100.0 + board / 1e6 + late
+    time, delay = al.board_to_host(host, board, window=1.0, delay=0.0005)
+    assert time == pytest.approx(100.0 + board / 1e6 + 0.0005, abs=1e-9)
+    assert delay == pytest.approx(late - 0.0005, abs=1e-9)
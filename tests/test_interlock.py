@@ -0,0 +1,60 @@
+import time
+import pytest
+from mechtex_rc_testbench import interlock as i
+from mechtex_rc_testbench import workers as w
+
+LIMITS = {'num_poles': 14, 'max_voltage': 80.0, 'max_current': 1e6, 'max_thrust': 100.0,
+          'max_rpm': 1e6}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_check_limits_current_in_mA():
+    data = dict(LIMITS, max_current=1000.0)
+    i.check_limits(data, current=0.9)
+    with pytest.raises(i.SafetyLimitError, match='current'):
+        i.check_limits(data, current=1.1)
+
+
+def test_require_limits():
+    with pytest.raises(ValueError, match='max_thrust'):
+        i.require_limits(dict(LIMITS, max_thrust=0.0))
+
+
+def test_trip_cuts_off_the_devices(simulated_supply, simulated_arduino):
+    worker = w.DeviceWorker(simulated_supply.port, simulated_arduino.port, telemetry_interval=0.0)
+    tripped = []
+    interlock = i.Interlock(worker, LIMITS, on_trip=tripped.append)
+    worker.sinks.append(interlock)
+    reader = w.ArduinoReader(worker)
+    interlock.start()
+    worker.start()
+    worker.ready.wait()
+    reader.start()
+    try:
+        for future in interlock.programLimits():
+            future.result()
+        worker.call('supply', 'setVoltage', 12.0)
+        worker.call('supply', 'turnOutputON')
+        worker.call('arduino', 'setPWM', 1500)
+        assert wait_for(lambda: interlock.violation is not None)
+        assert tripped == [interlock.violation]
+        assert 'thrust' in str(interlock.violation)
+        assert wait_for(lambda: simulated_arduino.pwm == 1000 and not simulated_supply.output)
+        assert simulated_supply.voltage == 0.0
+        # latched until resetTrip()
+        with pytest.raises(i.SafetyLimitError):
+            worker.call('supply', 'setVoltage', 12.0, timeout=2.0)
+    finally:
+        interlock.stop()
+        reader.stop()
+        reader.join()
+        worker.stop()
+        worker.join()
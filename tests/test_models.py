@@ -0,0 +1,49 @@
+import os
+import threading
+import time
+import pytest
+import serial
+from mechtex_rc_testbench import models as m
+
+
+@pytest.fixture
+def supply(simulated_supply):
+    device = m.PowerSupply(simulated_supply.port, timeout=0.2)
+    yield device
+    device.close()
+
+
+def test_query_reads_until_terminator(supply):
+    assert supply.getID() == 'MECHTEX,SIMULATED SUPPLY,0,1.0'
+
+
+def test_late_reply_is_not_taken_for_the_next_query(supply, simulated_supply):
+    supply.setOVP(12)
+    simulated_supply.latency = 0.4
+    with pytest.raises(serial.SerialTimeoutException):
+        supply.measure(['VOLT', 'CURR'])
+    simulated_supply.latency = 0.0
+    # the reply to measure() arrives while nothing is asking for it
+    time.sleep(0.5)
+    supply.invalidateCache()
+    assert supply.getOVP() == 12.0
+    assert supply.measure(['VOLT']).voltage == 0.0
+
+
+def test_reply_completed_after_timeout_is_discarded(supply, simulated_supply, monkeypatch):
+    sent = []
+
+    def split_send(data):
+        # first half now, the rest after the query has timed out
+        os.write(simulated_supply.master, data[:3])
+        timer = threading.Timer(0.4, os.write, (simulated_supply.master, data[3:]))
+        timer.start()
+        sent.append(timer)
+
+    monkeypatch.setattr(simulated_supply, 'send', split_send)
+    with pytest.raises(serial.SerialTimeoutException, match="b'0.0'"):
+        supply.getActualVoltage()
+    assert not supply._rxBuffer
+    sent[0].join()
+    monkeypatch.undo()
+    assert supply.getID() == 'MECHTEX,SIMULATED SUPPLY,0,1.0'
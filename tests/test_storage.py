@@ -0,0 +1,49 @@
+import os
+import time
+import numpy as np
+from mechtex_rc_testbench import storage as s
+
+
+def arduino_rows(start, count):
+    return [(float(row), row, row / 2, row * 2, 1000 + row) for row in range(start, start + count)]
+
+
+def test_npy_header_counts_only_written_rows(tmp_path):
+    path = str(tmp_path / 'run_arduino.npy')
+    writer = s.NpyResultWriter(path, s.ARDUINO_DTYPE, batch_size=10, chunk_rows=16)
+    assert writer.header_size % 64 == 0
+    writer.writeMany(arduino_rows(0, 25))
+    # written but not closed: the file is larger than the rows it holds
+    table = np.load(path)
+    assert len(table) == writer.rows_written == 25
+    assert np.array_equal(table['timestamp'], np.arange(25))
+    # buffered rows are not counted until they are written
+    writer.write(arduino_rows(25, 1)[0])
+    assert len(np.load(path, mmap_mode='r')) == 25
+    writer.close()
+    table = np.load(path)
+    assert len(table) == 26
+    assert table[-1]['pwm'] == 1025
+    assert os.path.getsize(path) == writer.header_size + 26 * s.ARDUINO_DTYPE.itemsize
+
+
+def test_npy_grows_past_several_chunks(tmp_path):
+    path = str(tmp_path / 'run_supply.npy')
+    writer = s.NpyResultWriter(path, s.SUPPLY_DTYPE, batch_size=7, chunk_rows=4)
+    for row in range(30):
+        writer.write((float(row), 12.0, row / 10))
+    writer.close()
+    table = np.load(path)
+    assert np.array_equal(table['time'], np.arange(30.0))
+
+
+def test_csv_rows_written_after_fsync_interval(tmp_path):
+    path = str(tmp_path / 'run_supply.csv')
+    writer = s.CsvResultWriter(path, ['time', 'voltage'], batch_size=1000, fsync_interval=0.05)
+    writer.write((0.0, 12.0))
+    # still buffered
+    assert '12.0' not in open(path).read()
+    time.sleep(0.06)
+    writer.write((0.1, 12.0))
+    assert len(open(path).read().splitlines()) == 3
+    writer.close()
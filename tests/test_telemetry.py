@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from mechtex_rc_testbench import telemetry as t
+
+
+@pytest.mark.parametrize('chunks', [[3, 3, 3], [7], [12], [1] * 11, [5, 9, 2], [8, 8]])
+def test_ring_buffer_keeps_the_last_values(chunks):
+    ring = t.RingBuffer(8)
+    values = []
+    for size in chunks:
+        block = np.arange(len(values), len(values) + size, dtype='f8')
+        if size == 1:
+            ring.append(block[0])
+        else:
+            ring.extend(block)
+        values.extend(block)
+    assert ring.count == len(values)
+    assert len(ring) == min(len(values), 8)
+    assert ring.latest() == values[-1]
+    for n in range(1, 10):
+        expected = np.asarray(values[-min(n, 8):])
+        assert np.array_equal(ring.window(n), expected)
+        assert ring.mean(n) == pytest.approx(expected.mean())
+        assert ring.std(n) == pytest.approx(expected.std())
+        assert ring.min(n) == expected.min()
+        assert ring.max(n) == expected.max()
+
+
+def test_wrapped_window_is_two_views():
+    ring = t.RingBuffer(4)
+    ring.extend(np.arange(6.0))
+    segments = ring.segments(4)
+    assert [list(segment) for segment in segments] == [[2.0, 3.0], [4.0, 5.0]]
+    assert all(np.shares_memory(segment, ring.data) for segment in segments)
+
+
+def test_empty_ring_buffer():
+    ring = t.RingBuffer(4)
+    assert np.isnan(ring.latest())
+    assert np.isnan(ring.mean(4))
+    assert np.isnan(ring.max(4))
+    assert len(ring.window(4)) == 0
+
+
+def test_telemetry_buffer_rpm_from_period():
+    telemetry = t.TelemetryBuffer(num_poles=14, capacity=16)
+    # 14 poles: 7 pulses per revolution, a 1000 us period is 8571 rpm
+    telemetry('arduino', 1.0, [(0, 50.0, 1000, 1500), (1000, 52.0, 0, 1500)])
+    assert telemetry['rpm'].window(2) == pytest.approx([120e6 / (1000 * 14), 0.0])
+    assert telemetry['thrust'].mean(2) == pytest.approx(51.0)
+    assert telemetry.count('arduino') == 2